@@ -0,0 +1,163 @@
+#! /usr/bin/python3
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+
+benchmarksPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarksPath, "..", "src"))
+from MediaLibrary import MediaLibrary, SubtitleCache
+from Patches import Patches
+from HTMLPYParser import HTMLPYParser
+from HTMLPYCache import HTMLPYCache
+
+"""
+microbenchmarks of the string processing the scan and the server do for every file/request
+every benchmark runs over the release names in corpus/release_names.txt and reports the time per call,
+results can be saved as a baseline and later runs compared to it, flagging whatever got slower than
+the threshold
+
+./benchmarks/micro_benchmark.py --save                 # write micro_baseline.json
+./benchmarks/micro_benchmark.py --compare              # compare with micro_baseline.json
+"""
+
+corpusPath = os.path.join(benchmarksPath, "corpus")
+defaultBaseline = os.path.join(benchmarksPath, "micro_baseline.json")
+mediaRoot = os.sep + os.path.join("media", "library") + os.sep # corpus paths are relative to this
+
+def loadCorpus():
+    with open(os.path.join(corpusPath, "release_names.txt"), "r") as corpusFile:
+        return [line.strip() for line in corpusFile if line.strip()]
+
+def makeBenchmarks():
+    """ name -> (function taking no arguments, calls it makes) """
+    corpus = loadCorpus()
+    patches = Patches(os.path.join(corpusPath, "patches.json"))
+    library = MediaLibrary([mediaRoot], ["mkv", "mp4", "mov"], ["srt"], os.path.join(corpusPath, "blacklist.json"), patches)
+    media = [path for path in corpus if library.isMediaFile(path)]
+    mediaFiles = [os.path.basename(path) for path in media]
+    stems = [os.path.splitext(file)[0] for file in mediaFiles]
+    properNames = [library.sanitizeFilename(file) for file in mediaFiles]
+    showNames = [library.extractShowName(path, name) or name for path, name in zip(media, properNames)]
+    # the scan tokenizes every filename once and passes the tokens on, the word cloud of the directory is cached
+    fileTokens = [library.tokenizeFilename(file) for file in mediaFiles]
+
+    subtitles = SubtitleCache()
+    for path in corpus:
+        if library.isSubtitleFile(path):
+            subtitles.addSubtitle(os.path.join(mediaRoot, path), mediaRoot)
+    absMedia = [os.path.join(mediaRoot, path) for path in media]
+
+    with open(os.path.join(benchmarksPath, "..", "frontend", "index.htmlpy"), "r") as htmlFile:
+        html = htmlFile.read()
+    htmlData = {'config': {'useTelemetry': True, 'telemetryInterval': 1000, 'gpuAvailable': False,
+                           'subtitlesDelay': 0, 'initialView': 'listView'}}
+    htmlCache = HTMLPYCache({})
+    cacheKeys = iter(range(sys.maxsize)) # addEntry keeps the first entry of a path
+
+    def compileHTML():
+        HTMLPYParser(html).compile(htmlData)
+
+    def minifyHTML():
+        htmlCache.addEntry(f"bench{next(cacheKeys)}", html)
+
+    return {
+        "MediaLibrary.sanitize":         (lambda: [library.sanitize(stem) for stem in stems], len(stems)),
+        "MediaLibrary.sanitizeFilename": (lambda: [library.sanitizeFilename(file) for file in mediaFiles], len(mediaFiles)),
+        "MediaLibrary.extractShowName":  (lambda: [library.extractShowName(path, name) for path, name in zip(media, properNames)], len(media)),
+        "MediaLibrary.tokenizeFilename": (lambda: [library.tokenizeFilename(file) for file in mediaFiles], len(mediaFiles)),
+        "MediaLibrary.extractShowName.tokens": (lambda: [library.extractShowName(path, tokens.name, tokens) for path, tokens in zip(media, fileTokens)], len(media)),
+        "MediaLibrary.extractLang":      (lambda: [library.extractLang(file) for file in mediaFiles], len(mediaFiles)),
+        "SubtitleCache.getSubtitles":    (lambda: [subtitles.getSubtitles(path) for path in absMedia], len(absMedia)),
+        "Patches.processString":         (lambda: [patches.processString(name) for name in showNames], len(showNames)),
+        "Patches.processTimestamp":      (lambda: [patches.processTimestamp(name) for name in showNames], len(showNames)),
+        "HTMLPYParser.compile":          (compileHTML, 1),
+        "HTMLPYCache.addEntry":          (minifyHTML, 1),
+    }
+
+def timeBenchmark(function, calls, repeat, minRoundSeconds):
+    """ best time per call in ns, of repeat rounds each long enough to be measured """
+    loops = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            function()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= minRoundSeconds * 1e9:
+            break
+        loops *= 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            function()
+        best = min(best, time.perf_counter_ns() - start)
+    return best / (loops * calls)
+
+def runBenchmarks(names, repeat, minRoundSeconds):
+    benchmarks = makeBenchmarks()
+    results = {}
+    for name, (function, calls) in benchmarks.items():
+        if names and not any(part in name for part in names):
+            continue
+        results[name] = round(timeBenchmark(function, calls, repeat, minRoundSeconds), 1)
+    return results
+
+def compare(results, baseline, threshold):
+    """ prints the comparison, returns the names that got slower than threshold percent """
+    regressions = []
+    print(f"{'benchmark':<40} {'baseline ns':>12} {'now ns':>12} {'change':>8}")
+    for name, nsPerCall in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<40} {'-':>12} {nsPerCall:>12.1f} {'new':>8}")
+            continue
+        change = (nsPerCall - base) / base * 100
+        flag = ""
+        if change > threshold:
+            flag = "  <-- regression"
+            regressions.append(name)
+        print(f"{name:<40} {base:>12.1f} {nsPerCall:>12.1f} {change:>+7.1f}%{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="microbenchmarks of the string processing hot paths")
+    parser.add_argument("names", nargs="*", help="only run the benchmarks with one of these in their name")
+    parser.add_argument("--repeat", type=int, default=5, help="rounds per benchmark, the best one counts")
+    parser.add_argument("--min-round", type=float, default=0.2, help="minimal seconds per round")
+    parser.add_argument("--save", nargs="?", const=defaultBaseline, help="save the results as a baseline")
+    parser.add_argument("--compare", nargs="?", const=defaultBaseline, help="compare the results with a baseline")
+    parser.add_argument("--threshold", type=float, default=10, help="percent slower than the baseline that counts as a regression")
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.names, args.repeat, args.min_round)
+
+    if args.save:
+        with open(args.save, "w") as jsonFile:
+            json.dump({
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "ns_per_call": results
+            }, jsonFile, indent=4)
+            jsonFile.write("\n")
+
+    if not args.compare:
+        print(json.dumps(results, indent=4))
+        return 0
+
+    with open(args.compare, "r") as jsonFile:
+        baseline = json.load(jsonFile)
+    if baseline.get("python") != platform.python_version():
+        print(f"the baseline was made with python {baseline.get('python')} and this is {platform.python_version()}, "
+              "the changes include the interpreter's")
+    regressions = compare(results, baseline["ns_per_call"], args.threshold)
+    if regressions:
+        print(f"{len(regressions)} benchmarks are more than {args.threshold}% slower than the baseline")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
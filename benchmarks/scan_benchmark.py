@@ -0,0 +1,240 @@
+#! /usr/bin/python3
+import os
+import sys
+import gc
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import MediaLibrary
+
+"""
+scan benchmark on a synthetic library
+generates a tree of zero byte media/subtitle files named the way release files usually are
+(Show.Name.S01E02.1080p.WEB-DL.x264-GROUP.mkv in Show Name/Season 1, movies in their own
+directories) with a blacklist that matches the naming, scans it with MediaLibrary and reports
+wall time, files per second, peak RSS and retained memory per media record as json
+
+./benchmarks/scan_benchmark.py --files 100000 --output results.json
+"""
+
+words = ["the", "last", "dark", "city", "house", "night", "star", "river", "king", "ghost", "blue", "iron",
+         "silent", "north", "broken", "golden", "wild", "lost", "black", "high", "empire", "doctor", "line",
+         "garden", "winter", "echo", "signal", "shadow", "harbor", "crown", "valley", "machine", "storm"]
+qualities = ["480p", "720p", "1080p", "2160p"]
+sources = ["WEB-DL", "WEBRip", "HDTV", "BluRay", "AMZN WEB-DL", "NF WEBRip"]
+codecs = ["x264", "x265", "H.264", "HEVC", "DDP5.1.H.264", "AAC2.0.H.264"]
+groups = ["NTb", "FLUX", "SPARKS", "RARBG", "YIFY", "GalaxyTV", "ION10", "playWEB", "CAKES", "GGEZ"]
+languages = ["eng", "spa", "ita", "jpn"]
+
+def makeBlacklist(path):
+    # the words of the naming that are not part of the title
+    compound = sorted(set(source for source in sources if " " in source or "-" in source) |
+                      set(codec for codec in codecs if "." in codec))
+    blacklist = {
+        "blacklist": qualities + groups + ["x264", "x265", "HEVC", "WEBRip", "HDTV", "BluRay", "AMZN", "NF", "REPACK"],
+        "compound_blacklist": compound
+    }
+    with open(path, "w") as jsonFile:
+        json.dump(blacklist, jsonFile)
+
+def makeTitle(rand, length):
+    return " ".join(rand.choice(words).capitalize() for _ in range(length))
+
+def releaseTag(rand):
+    return f"{rand.choice(qualities)}.{rand.choice(sources).replace(' ', '.')}.{rand.choice(codecs)}-{rand.choice(groups)}"
+
+def generateTree(root, files, subtitleRatio, movieRatio, seed):
+    """ returns (media files, subtitle files) written under root """
+    rand = random.Random(seed)
+    mediaCount = 0
+    subtitleCount = 0
+
+    def touch(path):
+        open(path, "w").close()
+
+    while mediaCount + subtitleCount < files:
+        if rand.random() < movieRatio:
+            title = makeTitle(rand, rand.randint(1, 4))
+            year = rand.randint(1950, 2024)
+            directory = os.path.join(root, "Movies", f"{title} ({year}) [{mediaCount}]")
+            os.makedirs(directory, exist_ok=True)
+            name = f"{title.replace(' ', '.')}.{year}.{releaseTag(rand)}"
+            touch(os.path.join(directory, name + ".mkv"))
+            mediaCount += 1
+            if rand.random() < subtitleRatio:
+                touch(os.path.join(directory, f"{name}.{rand.choice(languages)}.srt"))
+                subtitleCount += 1
+            continue
+
+        show = f"{makeTitle(rand, rand.randint(1, 3))} {mediaCount}"
+        for season in range(1, rand.randint(1, 8) + 1):
+            directory = os.path.join(root, "Shows", show, f"Season {season}")
+            os.makedirs(directory, exist_ok=True)
+            tag = releaseTag(rand) # a season is usually from the same release
+            for episode in range(1, rand.randint(6, 24) + 1):
+                name = f"{show.replace(' ', '.')}.S{season:02d}E{episode:02d}.{tag}"
+                touch(os.path.join(directory, name + ".mkv"))
+                mediaCount += 1
+                if rand.random() < subtitleRatio:
+                    touch(os.path.join(directory, f"{name}.{rand.choice(languages)}.srt"))
+                    subtitleCount += 1
+                if mediaCount + subtitleCount >= files:
+                    return mediaCount, subtitleCount
+
+    return mediaCount, subtitleCount
+
+def countTree(root):
+    """ (media files, subtitle files) under root, for a tree generated by an earlier run """
+    mediaCount = subtitleCount = 0
+    for _, _, files in os.walk(root):
+        for file in files:
+            if file.endswith(".mkv"):
+                mediaCount += 1
+            elif file.endswith(".srt"):
+                subtitleCount += 1
+    return mediaCount, subtitleCount
+
+def backdateTree(root, seconds):
+    """ directories modified right before a scan are not kept in the scan manifest """
+    past = time.time() - seconds
+    for directory, _, _ in os.walk(root):
+        os.utime(directory, (past, past))
+
+def currentRSS():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+def peakRSS():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # KiB on linux
+
+def makeLibrary(root, blacklistPath, workers, processes, manifestPath):
+    return MediaLibrary.MediaLibrary([root], ["mkv", "mp4"], ["srt"], blacklistPath, None,
+                                     scanWorkers=workers, scanProcesses=processes, manifestPath=manifestPath)
+
+def runScan(root, blacklistPath, workers, processes, manifestPath):
+    gc.collect()
+    rssBefore = currentRSS()
+    library = makeLibrary(root, blacklistPath, workers, processes, manifestPath)
+    start = time.perf_counter()
+    library.scan()
+    wallSeconds = time.perf_counter() - start
+    gc.collect()
+    retained = currentRSS() - rssBefore # includes memory the allocator didn't give back
+    records = len(library.media)
+    return library, {
+        "wall_seconds": round(wallSeconds, 3),
+        "records": records,
+        "retained_rss_bytes": retained,
+        "retained_rss_bytes_per_record": round(retained / records, 1) if records else None
+    }
+
+def traceScan(root, blacklistPath, workers):
+    """ python memory held by the library after a scan, exact but the scan runs a lot slower """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    library = makeLibrary(root, blacklistPath, workers, 1, None)
+    library.scan()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    records = len(library.media)
+    return {
+        "retained_bytes": retained,
+        "retained_bytes_per_record": round(retained / records, 1) if records else None
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="MediaLibrary scan benchmark on a synthetic library")
+    parser.add_argument("--files", type=int, default=10000, help="media + subtitle files to generate (10k to 1M)")
+    parser.add_argument("--subtitle-ratio", type=float, default=0.3, help="chance a media file has a subtitle file")
+    parser.add_argument("--movie-ratio", type=float, default=0.1, help="chance the next title is a movie and not a show")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--root", help="where to generate the tree (a temporary directory by default), reused if it exists (the generation params are the ones it was made with)")
+    parser.add_argument("--keep", action="store_true", help="don't remove the generated tree")
+    parser.add_argument("--workers", type=int, default=8, help="scanWorkers")
+    parser.add_argument("--processes", type=int, default=0, help="scanProcesses")
+    parser.add_argument("--manifest", action="store_true", help="also measure a second scan restored from the scan manifest")
+    parser.add_argument("--trace-memory", action="store_true", help="also measure the exact retained memory with tracemalloc (extra, slow scan)")
+    parser.add_argument("--output", help="json file to write the results to (stdout if not given)")
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix="shnoodle-bench-")
+    blacklistPath = os.path.join(root, "blacklist.json")
+    libraryRoot = os.path.join(root, "library")
+    treePath = os.path.join(root, "tree.json") # how the tree was generated and what's in it
+
+    try:
+        start = time.perf_counter()
+        if os.path.exists(libraryRoot):
+            # generated by a previous run, the results are about the tree that is there
+            tree = {"files": None, "subtitle_ratio": None, "movie_ratio": None, "seed": None}
+            if os.path.exists(treePath):
+                with open(treePath, "r") as jsonFile:
+                    tree = json.load(jsonFile)
+            tree["media"], tree["subtitles"] = countTree(libraryRoot)
+        else:
+            os.makedirs(libraryRoot)
+            tree = {"files": args.files, "subtitle_ratio": args.subtitle_ratio, "movie_ratio": args.movie_ratio, "seed": args.seed}
+            tree["media"], tree["subtitles"] = generateTree(libraryRoot, args.files, args.subtitle_ratio, args.movie_ratio, args.seed)
+            backdateTree(libraryRoot, 3600)
+            with open(treePath, "w") as jsonFile:
+                json.dump(tree, jsonFile)
+        makeBlacklist(blacklistPath)
+        generateSeconds = time.perf_counter() - start
+        files = tree["media"] + tree["subtitles"]
+
+        manifestPath = os.path.join(root, "manifest.json") if args.manifest else None
+        if manifestPath and os.path.exists(manifestPath):
+            os.remove(manifestPath)
+
+        library, scan = runScan(libraryRoot, blacklistPath, args.workers, args.processes, manifestPath)
+        scan["files_per_second"] = round(files / scan["wall_seconds"]) if files and scan["wall_seconds"] else None
+
+        results = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "params": {
+                "files": tree["files"],
+                "subtitle_ratio": tree["subtitle_ratio"],
+                "movie_ratio": tree["movie_ratio"],
+                "seed": tree["seed"],
+                "workers": args.workers,
+                "processes": args.processes
+            },
+            "tree": {"media": tree["media"], "subtitles": tree["subtitles"], "generate_seconds": round(generateSeconds, 3)},
+            "scan": scan
+        }
+
+        if manifestPath:
+            _, warm = runScan(libraryRoot, blacklistPath, args.workers, args.processes, manifestPath)
+            warm["files_per_second"] = round(files / warm["wall_seconds"]) if files and warm["wall_seconds"] else None
+            results["manifest_scan"] = warm
+
+        results["peak_rss_bytes"] = peakRSS() # before the traced scan, tracemalloc has its own overhead
+
+        if args.trace_memory:
+            del library
+            results["traced_memory"] = traceScan(libraryRoot, blacklistPath, args.workers)
+    finally:
+        if not args.keep and not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w") as jsonFile:
+            jsonFile.write(output + "\n")
+    print(output)
+
+if __name__ == "__main__":
+    main()
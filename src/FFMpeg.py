@@ -1,26 +1,73 @@
 import os
 import shutil
 import subprocess
+import tempfile
 import time
 import json
+import math
 import shUtils
-import random
+import zlib
+import concurrent.futures
+from enum import Enum
 from Shnoolog import Shnoolog
+from ProbeStore import ProbeStore
+from JobScheduler import JobScheduler
+from ThumbnailCache import ThumbnailCache
+from MediaStore import MediaType
 
 
 class FFMpeg:
-
-    def __init__(self, ffmpegPath, ffprobePath, cdnPath, patches) -> None:
+    class ThumbMode(Enum):
+        ACCURATE = "accurate" # the exact frame at the time code
+        FAST = "fast"         # the keyframe the seek lands on (and the cover art if there's one)
+
+    lowPriorityNiceness = 19
+    trickplayColumns = 10 # thumbnails in a row of a sprite sheet
+    trickplayRows = 10
+    trickplayQueueLimit = 4
+    probeWorkers = 4 # ffprobe processes for requests
+    probeQueueLimit = 64
+    jobPollSeconds = 0.25 # how often to check if the client of a request is still there while it waits for a job
+    thumbFormats = { # format -> (mime type, file extension)
+        'avif': ('image/avif', 'avif'),
+        'webp': ('image/webp', 'webp'),
+        'jpeg': ('image/jpeg', 'jpg'),
+    }
+    batchTimeCodeTypes = (0, 1, 2, 3, 4) # the thumbnail types the UI asks for
+
+    def __init__(self, ffmpegPath, ffprobePath, cdnPath, patches, probeStorePath=None, thumbWorkers=2, thumbQueueLimit=32,
+                 thumbCacheBytes=64*1024*1024, thumbSpillBytes=0, thumbBatch=True, thumbBatchWidths=(),
+                 thumbModes=None, thumbLatencyBudgetSeconds=2, trickplayIntervalSeconds=10, trickplayWidth=160) -> None:
         self.logger = Shnoolog("FFMpeg")
         self.ffmpeg = ffmpegPath
         self.ffprobe = ffprobePath
         self.videoSubDir="vd"
+        self.thumbSubDir="th"
+        self.trickplaySubDir="tp"
+        self.trickplayName = "trickplay.vtt"
         self.currentProcess=None
         self.cdnPath = cdnPath
-        self.mediaMetadata = {} #cache the probe output of files
+        self.probes = ProbeStore(probeStorePath) #cache the probe output of files
+        self.probes.load()
         self.playlistName = "shnoodle"
         self.tsName = "v_stream"
-        self.thumbCache = {} #cache the image data of a media
+        self.thumbCache = ThumbnailCache(thumbCacheBytes, os.path.join(cdnPath, self.thumbSubDir), thumbSpillBytes) #cache the image data of a media
+        self.thumbBatch = thumbBatch # render all the batchTimeCodeTypes of a media with one ffmpeg
+        self.thumbBatchWidths = thumbBatchWidths # widths to render along with the requested one in batch mode
+        self.thumbModes = {} # media type -> ThumbMode
+        for mediaType, mode in (thumbModes or {}).items():
+            try:
+                self.thumbModes[mediaType] = FFMpeg.ThumbMode(mode)
+            except ValueError:
+                self.logger.error(f"Unknown thumbnail mode {mode} for {mediaType}, using {FFMpeg.ThumbMode.ACCURATE.value}")
+        self.thumbLatencyBudgetSeconds = thumbLatencyBudgetSeconds
+        self.thumbJobs = JobScheduler("Thumbnails", workers=thumbWorkers, queueLimit=thumbQueueLimit)
+        self.trickplayIntervalSeconds = trickplayIntervalSeconds
+        self.trickplayWidth = trickplayWidth
+        self.trickplayJobs = JobScheduler("Trickplay", workers=1, queueLimit=self.trickplayQueueLimit)
+        self.trickplayProcess = None
+        self.trickplayFailed = set() # uuids the sprite sheets couldn't be rendered for, not tried again
+        self.probeJobs = JobScheduler("Probes", workers=self.probeWorkers, queueLimit=self.probeQueueLimit)
         self.shutitup = False
         self.patches = patches
 
@@ -64,6 +111,14 @@ class FFMpeg:
 
     def clearVideoFiles(self):
         self.stopTranscodingProcess()
+        self.thumbCache.clear()
+        self.trickplayJobs.shutdown()
+        if self.trickplayProcess and self.trickplayProcess.poll() is None:
+            self.trickplayProcess.kill()
+        for subDir in (self.trickplaySubDir, self.thumbSubDir):
+            generatedDir = os.path.join(self.cdnPath, subDir)
+            if os.path.exists(generatedDir):
+                shutil.rmtree(generatedDir, ignore_errors=True)
 
         targetDir = os.path.join(self.cdnPath, self.videoSubDir)
         if os.path.exists(targetDir):
@@ -74,11 +129,49 @@ class FFMpeg:
                 time.sleep(1)
                 self.clearVideoFiles()
 
-    def probe(self, mediaPath, mediaUUID):
+    def isTranscoding(self) -> bool:
+        process = self.currentProcess
+        return process is not None and process.poll() is None
+
+    def isProbed(self, mediaPath, size, mtime) -> bool:
+        return self.probes.contains(mediaPath, size, mtime)
+
+    def lowerPriority(self, pid, idle=False):
+        """ idle: only run when nothing else wants the cpu (SCHED_IDLE, linux only) """
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, self.lowPriorityNiceness)
+            if idle and hasattr(os, 'SCHED_IDLE'):
+                os.sched_setscheduler(pid, os.SCHED_IDLE, os.sched_param(0))
+        except OSError as e:
+            self.logger.warning(f"Failed to lower the priority of {pid}: {e}")
+
+    def probe(self, mediaPath, size=None, mtime=None, lowPriority=False, abandoned=None):
+        """
+        ffprobe format and streams of the file (only the fields ProbeStore keeps)
+        size/mtime of the file are taken from the file system when not given
+        abandoned: for requests, returns True when the client is gone. ffprobe runs on probeJobs then
+        (requests for the same file share one run), None is returned once it's True and ffprobe is killed
+        if no other request waits for it. raises JobScheduler.QueueFull when too many probes are running
+        """
+        if size is None or mtime is None:
+            try:
+                fileStats = os.stat(mediaPath)
+            except OSError as e:
+                self.logger.error(f"Failed to stat {mediaPath}: {e}")
+                return None
+            size, mtime = fileStats.st_size, fileStats.st_mtime
 
-        if mediaUUID in self.mediaMetadata.keys():
-            return self.mediaMetadata[mediaUUID]
+        data = self.probes.get(mediaPath, size, mtime)
+        if data:
+            return data
 
+        if abandoned is None:
+            return self.__runProbe(mediaPath, size, mtime, lowPriority)
+
+        job = self.probeJobs.submit(mediaPath, self.__runProbe, mediaPath, size, mtime, lowPriority)
+        return self.__waitForJob(self.probeJobs, mediaPath, job, abandoned)
+
+    def __runProbe(self, mediaPath, size, mtime, lowPriority):
         args = [self.ffprobe]
 
         args += ['-print_format','json']
@@ -87,23 +180,70 @@ class FFMpeg:
         args += [mediaPath]
 
         self.logger.info("Running command: {}".format(" ".join(args)))
-        result = subprocess.run(args, capture_output=True, text=True)
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL, text=True)
+        JobScheduler.attachProcess(process)
+        if lowPriority:
+            self.lowerPriority(process.pid)
+        output, _ = process.communicate()
 
-        if result.returncode != 0:
+        if process.returncode != 0:
             return None
 
-        output = result.stdout
         try:
             data = json.loads(output)
         except json.JSONDecodeError as e:
             self.logger.error(f"failed to parse ffprobe command. JSON: {e.msg}")
             return None
 
-        self.mediaMetadata[mediaUUID] = data
-        return data
+        return self.probes.put(mediaPath, size, mtime, data)
+
+    def __waitForJob(self, scheduler, key, job, abandoned):
+        """
+        the result of job, None if abandoned() returned True before it was done or the scheduler was shut down
+        """
+        try:
+            if abandoned is None:
+                return job.result()
+            while True:
+                try:
+                    return job.result(timeout=self.jobPollSeconds)
+                except concurrent.futures.TimeoutError: # not the builtin TimeoutError before python 3.11
+                    if abandoned():
+                        return None
+        except (concurrent.futures.CancelledError, JobScheduler.Cancelled):
+            return None
+        finally:
+            scheduler.release(key, job)
 
-    def showTimeCodes(self, timeCode, defaultTimestamp="00:00:00"):
-        secondsRand = random.randint(10,50)
+    @staticmethod
+    def probeSummary(data):
+        """ duration (seconds), resolution and codecs of a probe result, for the library list """
+        summary = {}
+        try:
+            summary['duration'] = round(float(data['format']['duration']), 1)
+        except (KeyError, TypeError, ValueError):
+            pass
+
+        for stream in data.get('streams', []):
+            match stream.get('codec_type'):
+                case 'video':
+                    if 'video_codec' in summary or stream.get('disposition', {}).get('attached_pic'):
+                        continue # only the main video stream, cover art is a video stream too
+                    summary['video_codec'] = stream.get('codec_name')
+                    if stream.get('width') and stream.get('height'):
+                        summary['resolution'] = "{}x{}".format(stream['width'], stream['height'])
+                case 'audio':
+                    if 'audio_codec' not in summary:
+                        summary['audio_codec'] = stream.get('codec_name')
+        return summary
+
+    @staticmethod
+    def timeCodeSeconds(mediaUUID, timeCode):
+        """ seconds (10-50) into the minute of a time code, always the same for a media so its thumbnails are too """
+        return 10 + zlib.crc32(f"{mediaUUID}:{timeCode}".encode()) % 41
+
+    def showTimeCodes(self, timeCode, defaultTimestamp="00:00:00", mediaUUID=""):
+        secondsRand = self.timeCodeSeconds(mediaUUID, timeCode)
         match timeCode:
             case 0:
                 return defaultTimestamp
@@ -117,8 +257,8 @@ class FFMpeg:
                 return "00:08:{}".format(secondsRand)
         return defaultTimestamp
 
-    def movieTimeCodes(self, timeCode, defaultTimestamp="00:00:00"):
-        secondsRand = random.randint(10,50)
+    def movieTimeCodes(self, timeCode, defaultTimestamp="00:00:00", mediaUUID=""):
+        secondsRand = self.timeCodeSeconds(mediaUUID, timeCode)
         match timeCode:
             case 1:
                 return "00:05:{}".format(secondsRand)
@@ -134,77 +274,346 @@ class FFMpeg:
         timeCode = min(9, max(0,timeCode))
         return "00:00:0{}".format(timeCode)
 
-    def timeCodeToTime(self, timeCodeType, mediaInfo):
-        if mediaInfo['metadata']['type'] == "Show":
+    def timeCodeToTime(self, timeCodeType, mediaRecord, mediaUUID=""):
+        if mediaRecord.type == MediaType.SHOW:
             defaultTimestamp = "00:00:00"
-            if self.patches:
-                defaultTimestamp = self.patches.processTimestamp(mediaInfo['metadata']['show'])
-            return self.showTimeCodes(timeCodeType, defaultTimestamp)
+            if self.patches and mediaRecord.show:
+                defaultTimestamp = self.patches.processTimestamp(mediaRecord.show)
+            return self.showTimeCodes(timeCodeType, defaultTimestamp, mediaUUID)
 
-        if mediaInfo['metadata']['type'] == "Movie":
-            return self.movieTimeCodes(timeCodeType)
+        if mediaRecord.type == MediaType.MOVIE:
+            return self.movieTimeCodes(timeCodeType, mediaUUID=mediaUUID)
 
         return self.clipTimeCodes(timeCodeType)
 
-    def generateThumbnail(self, mediaPath, mediaUUID, mediaInfo, timeCodeType, width, quality=70):
-        if mediaUUID not in self.thumbCache:
-            self.thumbCache[mediaUUID] = {}
+    def generateThumbnail(self, mediaPath, mediaUUID, mediaRecord, timeCodeType, width, quality=70, imageFormat='webp', abandoned=None):
+        """
+        the thumbnail from the cache, or from ffmpeg run by thumbJobs (requests for the same thumbnail
+        at the same time share one ffmpeg run)
+        in batch mode a missing thumbnail of one of the batchTimeCodeTypes renders all of them (at width
+        and thumbBatchWidths) with one ffmpeg run
+        abandoned: returns True when the client is gone, None is returned once it's True (and ffmpeg is
+        killed if no other request waits for the same run)
+        raises JobScheduler.QueueFull when too many thumbnails are already being generated
+        """
+        cached = self.thumbCache.get((mediaUUID, timeCodeType, width, imageFormat))
+        if cached:
+            return cached
+
+        if self.thumbBatch and timeCodeType in self.batchTimeCodeTypes:
+            timeCodeTypes = self.batchTimeCodeTypes
+            widths = tuple(sorted(set([width] + list(self.thumbBatchWidths))))
+            key = (mediaUUID, widths, imageFormat)
         else:
-            if timeCodeType in self.thumbCache[mediaUUID]:
-                return self.thumbCache[mediaUUID][timeCodeType]
-
-        imageCache = {
-            'data' : b'',
-            'mime' : 'webp/image',
-            'size' : 0,
-            'width' : 0
-        }
+            timeCodeTypes = (timeCodeType,)
+            widths = (width,)
+            key = (mediaUUID, timeCodeType, width, imageFormat)
 
-        args = [self.ffmpeg]
-
-        if self.shutitup:
-            args += ['-hide_banner']
-            args += ['-loglevel', 'error']
+        job = self.thumbJobs.submit(key, self.__renderThumbnails, mediaPath, mediaUUID, mediaRecord, timeCodeTypes, widths, quality, imageFormat)
+        thumbs = self.__waitForJob(self.thumbJobs, key, job, abandoned)
+        if thumbs is None:
+            return None
+        return thumbs[(timeCodeType, width)]
 
-        args += [ '-ss', self.timeCodeToTime(timeCodeType, mediaInfo)]
-        args += ['-i', mediaPath ]
-        args += ['-vframes', '1']
-        args += ['-f', 'image2pipe'] # output image data to stdout
-        # image prop
-        if quality:
-            args += ['-quality', "{}".format(quality)]
-        args += ['-preset', 'photo']
-        if width:
-            args += ['-vf' , 'scale={}:-1'.format(width)] # keep aspect ratio
-        args += ['-vcodec', 'libwebp']
-        # output bin data to std
-        args += ['-']
+    def thumbnailMode(self, mediaRecord):
+        return self.thumbModes.get(mediaRecord.type.value, self.ThumbMode.ACCURATE)
 
+    def coverArtStream(self, mediaPath):
+        """
+        index of the embedded cover art stream (mp4 cover, mkv image attachment) or None
+        only known once the file was probed, ffprobe isn't run for it (it would only slow the thumbnail down)
+        """
+        try:
+            fileStats = os.stat(mediaPath)
+        except OSError as e:
+            self.logger.error(f"Failed to stat {mediaPath}: {e}")
+            return None
+        data = self.probes.get(mediaPath, fileStats.st_size, fileStats.st_mtime)
+        if not data:
+            return None
+        for stream in data.get('streams', []):
+            if stream.get('codec_type') == 'video' and stream.get('disposition', {}).get('attached_pic'):
+                return stream.get('index')
+        return None
+
+    def __thumbnailCodecArgs(self, quality, imageFormat):
+        """ quality is 0 (lowest) - 100 (highest) for every format """
+        args = []
+        match imageFormat:
+            case 'avif':
+                args += ['-vcodec', 'libaom-av1']
+                args += ['-still-picture', '1']
+                args += ['-cpu-used', '8']
+                if quality:
+                    args += ['-crf', "{}".format(round((100 - quality) * 63 / 100))]
+            case 'jpeg':
+                args += ['-vcodec', 'mjpeg']
+                if quality:
+                    args += ['-q:v', "{}".format(round(2 + (100 - quality) * 29 / 100))]
+            case _:
+                if quality:
+                    args += ['-quality', "{}".format(quality)]
+                args += ['-preset', 'photo']
+                args += ['-vcodec', 'libwebp']
+        return args
+
+    @staticmethod
+    def __thumbnailMuxerArgs(imageFormat):
+        if imageFormat == 'avif':
+            return ['-f', 'avif']
+        return ['-f', 'image2', '-update', '1'] # a single image, not a sequence
+
+    def __thumbnailInputArgs(self, mediaPath, mediaUUID, mediaRecord, timeCodeType, mode, coverStream):
+        """ returns (input args, stream of the input to take the frame from) """
+        if coverStream is not None and timeCodeType == 0:
+            return ['-i', mediaPath], str(coverStream)
+
+        args = []
+        if mode == self.ThumbMode.FAST:
+            # decode only keyframes and take the one the seek lands on, not the exact frame at the time code
+            args += ['-skip_frame', 'nokey']
+            args += ['-noaccurate_seek']
+        args += ['-ss', self.timeCodeToTime(timeCodeType, mediaRecord, mediaUUID)]
+        args += ['-i', mediaPath]
+        return args, 'v:0'
+
+    def __runThumbnailProcess(self, args, timeoutSeconds=None):
+        """ returns what ffmpeg wrote to stdout """
         self.logger.info("Running thumb command: {}".format(" ".join(args)))
         # prevent stdin to get stuck after we done with the process we direct it to devnull (i.e. /dev/null in linux)
         devnull = open(os.devnull)
         ffmpeg_process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=devnull)
+        JobScheduler.attachProcess(ffmpeg_process)
         try:
-            imageData, errors = ffmpeg_process.communicate()
-        except TimeoutError:
+            imageData, errors = ffmpeg_process.communicate(timeout=timeoutSeconds)
+        except subprocess.TimeoutExpired:
+            self.logger.warning(f"Thumbnail took more than {timeoutSeconds:.1f} seconds, stopping it")
             ffmpeg_process.kill()
             imageData, errors = ffmpeg_process.communicate()
         devnull.close()
 
-
         if errors:
             self.logger.error(errors)
+        return imageData
+
+    @staticmethod
+    def thumbnail(imageData, width, imageFormat='webp'):
+        return {
+            'data' : imageData,
+            'mime' : FFMpeg.thumbFormats[imageFormat][0],
+            'size' : len(imageData),
+            'width' : width
+        }
 
-        imageCache['data'] = imageData
-        imageCache['mime'] = 'webp/image'
-        imageCache['size'] = len(imageData)
-        imageCache['width'] = width
+    def __renderThumbnails(self, mediaPath, mediaUUID, mediaRecord, timeCodeTypes, widths, quality, imageFormat):
+        """
+        returns {(timeCodeType, width): thumbnail}, all of them are cached
+        in fast mode thumbnails that came out empty are rendered again with accurate seeking if there's
+        time left of thumbLatencyBudgetSeconds
+        """
+        start = time.monotonic()
+        mode = self.thumbnailMode(mediaRecord)
+        coverStream = None
+        if mode == self.ThumbMode.FAST and 0 in timeCodeTypes:
+            coverStream = self.coverArtStream(mediaPath)
+
+        thumbs = self.__runThumbnails(mediaPath, mediaUUID, mediaRecord, timeCodeTypes, widths, quality, imageFormat, mode, coverStream)
+
+        if mode == self.ThumbMode.FAST and not JobScheduler.isCancelled():
+            missing = tuple(timeCodeType for timeCodeType in timeCodeTypes if not all(thumbs[(timeCodeType, width)]['size'] for width in widths))
+            budgetLeft = self.thumbLatencyBudgetSeconds - (time.monotonic() - start)
+            if missing and budgetLeft > 0:
+                thumbs.update(self.__runThumbnails(mediaPath, mediaUUID, mediaRecord, missing, widths, quality, imageFormat, self.ThumbMode.ACCURATE, None, budgetLeft))
+
+        if JobScheduler.isCancelled():
+            raise JobScheduler.Cancelled() # ffmpeg was killed, don't cache what it didn't finish
+
+        for (timeCodeType, width), thumb in thumbs.items():
+            self.thumbCache.put((mediaUUID, timeCodeType, width, imageFormat), thumb)
+        return thumbs
+
+    def __runThumbnails(self, mediaPath, mediaUUID, mediaRecord, timeCodeTypes, widths, quality, imageFormat, mode, coverStream, timeoutSeconds=None):
+        """
+        every time code type at every width with one ffmpeg
+        a single thumbnail is piped out of ffmpeg (unless it's avif, the avif muxer can't write to a pipe),
+        for more the file is opened once per time code (each
+        input seeks on its own) and every frame is split and scaled to all the widths by one filter graph
+        returns {(timeCodeType, width): thumbnail}
+        """
+        args = [self.ffmpeg]
 
-        self.thumbCache[mediaUUID][timeCodeType] = imageCache
+        if self.shutitup:
+            args += ['-hide_banner']
+            args += ['-loglevel', 'error']
 
-        return imageCache
+        if len(timeCodeTypes) == 1 and len(widths) == 1 and imageFormat != 'avif':
+            timeCodeType, width = timeCodeTypes[0], widths[0]
+            inputArgs, stream = self.__thumbnailInputArgs(mediaPath, mediaUUID, mediaRecord, timeCodeType, mode, coverStream)
+            args += inputArgs
+            args += ['-map', '0:{}'.format(stream)]
+            args += ['-vframes', '1']
+            args += ['-f', 'image2pipe'] # output image data to stdout
+            if width:
+                args += ['-vf' , 'scale={}:-1'.format(width)] # keep aspect ratio
+            args += self.__thumbnailCodecArgs(quality, imageFormat)
+            # output bin data to std
+            args += ['-']
+            return {(timeCodeType, width): self.thumbnail(self.__runThumbnailProcess(args, timeoutSeconds), width, imageFormat)}
+
+        thumbDir = os.path.join(self.cdnPath, self.thumbSubDir)
+        os.makedirs(thumbDir, exist_ok=True)
+        targetDir = tempfile.mkdtemp(prefix="batch-", dir=thumbDir)
+
+        graph = []
+        outputs = {} # (timeCodeType, width) -> (filter output label, file)
+        for inputIndex, timeCodeType in enumerate(timeCodeTypes):
+            inputArgs, stream = self.__thumbnailInputArgs(mediaPath, mediaUUID, mediaRecord, timeCodeType, mode, coverStream)
+            args += inputArgs
+            scaled = ["t{}w{}".format(inputIndex, width) for width in widths]
+            if len(widths) > 1:
+                graph.append("[{}:{}]split={}{}".format(inputIndex, stream, len(widths), "".join("[s{}]".format(label) for label in scaled)))
+                sources = ["s{}".format(label) for label in scaled]
+            else:
+                sources = ["{}:{}".format(inputIndex, stream)]
+            for source, label, width in zip(sources, scaled, widths):
+                scale = 'scale={}:-1'.format(width) if width else 'null' # keep aspect ratio
+                graph.append("[{}]{}[{}]".format(source, scale, label))
+                outputs[(timeCodeType, width)] = (label, os.path.join(targetDir, label + "." + self.thumbFormats[imageFormat][1]))
+        args += ['-filter_complex', ";".join(graph)]
+
+        for label, file in outputs.values():
+            args += ['-map', "[{}]".format(label)]
+            args += ['-frames:v', '1']
+            args += self.__thumbnailCodecArgs(quality, imageFormat)
+            args += self.__thumbnailMuxerArgs(imageFormat)
+            args += ['-y', file]
+
+        self.__runThumbnailProcess(args, timeoutSeconds)
+
+        thumbs = {}
+        for (timeCodeType, width), (_, file) in outputs.items():
+            imageData = b''
+            try:
+                with open(file, "rb") as imageFile:
+                    imageData = imageFile.read()
+            except OSError:
+                if not JobScheduler.isCancelled():
+                    self.logger.error(f"ffmpeg didn't create the thumbnail {timeCodeType} of {mediaPath}")
+            thumbs[(timeCodeType, width)] = self.thumbnail(imageData, width, imageFormat)
+
+        shutil.rmtree(targetDir, ignore_errors=True)
+        return thumbs
+
+    ########################################################################
+    # trickplay (seek previews)
+    ########################################################################
+
+    def trickplayPath(self, mediaUUID):
+        """ path of the WebVTT thumbnail track of the media, it exists once the sprite sheets are done """
+        return os.path.join(self.cdnPath, self.trickplaySubDir, mediaUUID, self.trickplayName)
+
+    def startTrickplay(self, mediaPath, mediaUUID):
+        """ renders the trickplay sprite sheets of the media in the background, if they aren't already """
+        if mediaUUID in self.trickplayFailed or os.path.exists(self.trickplayPath(mediaUUID)):
+            return
+        try:
+            # nobody waits for it, it keeps running after the request that started it is done
+            self.trickplayJobs.submit(mediaUUID, self.__trickplayJob, mediaPath, mediaUUID, waiter=False)
+        except JobScheduler.QueueFull as e:
+            self.logger.warning(f"Not generating trickplay for {mediaUUID}, {e}")
+
+    @staticmethod
+    def vttTime(seconds):
+        hours, rest = divmod(seconds, 3600)
+        minutes, seconds = divmod(rest, 60)
+        return "{:02d}:{:02d}:{:06.3f}".format(int(hours), int(minutes), seconds)
+
+    def trickplayTrack(self, duration, width, height, sheetName):
+        """ WebVTT track pointing every interval of the media to its tile in the sprite sheets """
+        interval = self.trickplayIntervalSeconds
+        perSheet = self.trickplayColumns * self.trickplayRows
+        lines = ["WEBVTT", ""]
+        for index in range(math.ceil(duration / interval)):
+            sheet, tile = divmod(index, perSheet)
+            row, column = divmod(tile, self.trickplayColumns)
+            lines.append("{} --> {}".format(self.vttTime(index * interval), self.vttTime(min((index + 1) * interval, duration))))
+            lines.append("{}#xywh={},{},{},{}".format(sheetName % (sheet + 1), column * width, row * height, width, height))
+            lines.append("")
+        return "\n".join(lines)
+
+    def __trickplayJob(self, mediaPath, mediaUUID):
+        try:
+            rendered = self.__renderTrickplay(mediaPath, mediaUUID)
+        except Exception as e:
+            self.logger.error(f"Failed to generate trickplay for {mediaPath}: {e}")
+            rendered = False
+        if not rendered:
+            self.trickplayFailed.add(mediaUUID)
+
+    def __renderTrickplay(self, mediaPath, mediaUUID):
+        """ returns False if the sprite sheets couldn't be rendered """
+        data = self.probe(mediaPath, lowPriority=True)
+        if not data:
+            self.logger.error(f"Failed to probe {mediaPath}, no trickplay for it")
+            return False
+
+        try:
+            duration = float(data['format']['duration'])
+        except (KeyError, TypeError, ValueError):
+            self.logger.error(f"No duration for {mediaPath}, no trickplay for it")
+            return False
+
+        width = self.trickplayWidth
+        height = round(width * 9 / 16)
+        for stream in data.get('streams', []):
+            if stream.get('codec_type') == 'video' and not stream.get('disposition', {}).get('attached_pic'):
+                if stream.get('width') and stream.get('height'):
+                    height = round(width * stream['height'] / stream['width'])
+                break
+        height += height % 2 # most encoders want even sizes
+
+        targetDir = os.path.dirname(self.trickplayPath(mediaUUID))
+        if os.path.exists(targetDir):
+            shutil.rmtree(targetDir, ignore_errors=True) # leftovers of a run that didn't finish
+        os.makedirs(targetDir)
+        sheetName = "sheet_%03d.jpg"
+
+        args = [self.ffmpeg]
 
+        if self.shutitup:
+            args += ['-hide_banner']
+            args += ['-loglevel', 'error']
 
+        # only keyframes are decoded, a preview doesn't have to be the exact frame
+        args += ['-skip_frame', 'nokey']
+        args += ['-i', mediaPath]
+        args += ['-map', '0:v:0']
+        args += ['-vf', 'fps=1/{},scale={}:{},tile={}x{}'.format(self.trickplayIntervalSeconds, width, height, self.trickplayColumns, self.trickplayRows)]
+        args += ['-vcodec', 'mjpeg']
+        args += ['-q:v', '5']
+        args += ['-f', 'image2']
+        args += ['-y', os.path.join(targetDir, sheetName)]
+
+        self.logger.info("Running trickplay command: {}".format(" ".join(args)))
+        start = time.monotonic()
+        process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+        self.trickplayProcess = process
+        self.lowerPriority(process.pid, idle=True)
+        _, errors = process.communicate()
+        self.trickplayProcess = None
+
+        if process.returncode != 0:
+            self.logger.error(f"Failed to generate trickplay for {mediaPath}: {errors}")
+            shutil.rmtree(targetDir, ignore_errors=True)
+            return False
+
+        # the track is written last, it existing means the sprite sheets are all there
+        trackPath = self.trickplayPath(mediaUUID)
+        with open(trackPath + ".tmp", "w") as trackFile:
+            trackFile.write(self.trickplayTrack(duration, width, height, sheetName))
+        os.replace(trackPath + ".tmp", trackPath)
+        self.logger.info(f"Trickplay of {mediaPath} done in {time.monotonic() - start:.1f} seconds")
+        return True
 
     def transcodeVideo(self, mediaPath, mediaUUID,
                         subtitleStream=None,
@@ -0,0 +1,125 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+runs jobs on a fixed number of worker threads with a cap on how many can wait
+jobs have a key, a job submitted while another with the same key is queued or running isn't
+run again, the caller gets the future of the one already submitted so all of them share its result
+when the number of queued + running jobs reaches the cap new jobs are refused with QueueFull
+(so a burst of requests fails fast instead of piling up threads and processes)
+every submit counts as a waiter of the job and should be matched with a release once the caller is
+done waiting, when the last waiter of a job releases it before it's done the job is cancelled: it
+won't start if it's still queued and the processes it attached are killed if it's running
+jobs submitted with waiter=False run in the background, they have no waiter and are never cancelled
+"""
+
+class JobScheduler:
+    class QueueFull(Exception):
+        pass
+
+    class Cancelled(Exception):
+        pass
+
+    class Job:
+        __slots__ = ('future', 'waiters', 'background', 'processes', 'cancelled')
+
+        def __init__(self, background=False) -> None:
+            self.future = None
+            self.waiters = 0 if background else 1
+            self.background = background # nobody waits for it, it's never cancelled
+            self.processes = []
+            self.cancelled = False
+
+    __current = threading.local() # the job the worker thread is running
+
+    def __init__(self, name, workers=2, queueLimit=32) -> None:
+        self.workers = max(1, workers)
+        self.queueLimit = max(0, queueLimit)
+        self.__pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=name)
+        self.__jobs = {} # key -> Job that is queued/running
+        self.__lock = threading.Lock()
+
+    def __run(self, key, job, function, args):
+        JobScheduler.__current.job = job
+        try:
+            result = function(*args)
+            if job.cancelled:
+                raise JobScheduler.Cancelled() # its processes were killed, the result is partial
+            return result
+        finally:
+            JobScheduler.__current.job = None
+            with self.__lock:
+                if self.__jobs.get(key) is job:
+                    del self.__jobs[key]
+
+    def submit(self, key, function, *args, waiter=True):
+        """
+        returns the future of the job with key, function(*args) is only run if there's no such job yet
+        with waiter=False the caller doesn't wait for the job (and doesn't release it), the job runs to the end
+        raises QueueFull when there are too many jobs
+        """
+        with self.__lock:
+            job = self.__jobs.get(key)
+            if job:
+                if waiter:
+                    job.waiters += 1
+                else:
+                    job.background = True
+                return job.future
+            if len(self.__jobs) >= self.workers + self.queueLimit:
+                raise JobScheduler.QueueFull(f"{len(self.__jobs)} jobs are already queued")
+            job = JobScheduler.Job(background=not waiter)
+            job.future = self.__pool.submit(self.__run, key, job, function, args)
+            self.__jobs[key] = job
+            return job.future
+
+    def release(self, key, future):
+        """ the caller that got future from submit isn't waiting for it anymore """
+        with self.__lock:
+            job = self.__jobs.get(key)
+            if not job or job.future is not future:
+                return # done already
+            job.waiters -= 1
+            if job.waiters > 0 or job.background:
+                return
+            job.cancelled = True
+            del self.__jobs[key] # the next request for key starts a new job
+            processes = list(job.processes)
+
+        future.cancel()
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+
+    @staticmethod
+    def attachProcess(process):
+        """ process is killed if the job running on this thread is cancelled, does nothing outside of a job """
+        job = getattr(JobScheduler.__current, 'job', None)
+        if not job:
+            return
+        job.processes.append(process)
+        if job.cancelled:
+            process.kill()
+
+    @staticmethod
+    def isCancelled():
+        """ if the job running on this thread was cancelled """
+        job = getattr(JobScheduler.__current, 'job', None)
+        return job is not None and job.cancelled
+
+    def pending(self):
+        return len(self.__jobs)
+
+    def shutdown(self):
+        """ queued jobs never start and the processes of the running ones are killed """
+        with self.__lock:
+            jobs = list(self.__jobs.values())
+            self.__jobs.clear()
+            for job in jobs:
+                job.cancelled = True
+                job.future.cancel()
+        self.__pool.shutdown(wait=False, cancel_futures=True)
+        for job in jobs:
+            for process in list(job.processes):
+                if process.poll() is None:
+                    process.kill()
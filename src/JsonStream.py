@@ -0,0 +1,81 @@
+import json
+
+"""
+writes json to a socket while it's being serialized
+the top level object/array is written one member at a time (each member with json.dumps so
+it's still the c encoder doing the work) and the output is flushed in batches of batchBytes,
+as http/1.1 chunks when chunked, so a response starts going out right away and the memory it
+takes doesn't grow with the size of the response
+"""
+
+class ChunkedJsonWriter:
+    batchBytes = 64 * 1024
+
+    def __init__(self, write, chunked=True, compressor=None, tee=None) -> None:
+        """
+        write: called with the bytes to send, expected to raise if the client is gone
+        compressor: zlib compress object for a compressed response
+        tee: list that gets the (uncompressed) bytes of the json as they are written
+        """
+        self.__write = write
+        self.__chunked = chunked
+        self.__compressor = compressor
+        self.__tee = tee
+        self.__pieces = []
+        self.__size = 0
+
+    def __emit(self, text):
+        self.__pieces.append(text)
+        self.__size += len(text)
+        if self.__size >= self.batchBytes:
+            self.flush()
+
+    def __send(self, data):
+        if not data:
+            return # an empty chunk is the end of the response
+        if self.__chunked:
+            self.__write(b"%x\r\n%b\r\n" % (len(data), data))
+        else:
+            self.__write(data)
+
+    def flush(self):
+        data = "".join(self.__pieces).encode()
+        self.__pieces = []
+        self.__size = 0
+        if self.__tee is not None:
+            self.__tee.append(data)
+        if self.__compressor:
+            data = self.__compressor.compress(data)
+        self.__send(data)
+
+    def writeMapping(self, items):
+        """ items: iterable of (key, value) """
+        self.__emit("{")
+        first = True
+        for key, value in items:
+            self.__emit(("" if first else ", ") + json.dumps(str(key)) + ": " + json.dumps(value))
+            first = False
+        self.__emit("}")
+
+    def writeSequence(self, items):
+        self.__emit("[")
+        first = True
+        for value in items:
+            self.__emit(("" if first else ", ") + json.dumps(value))
+            first = False
+        self.__emit("]")
+
+    def writeObject(self, obj):
+        if isinstance(obj, dict):
+            self.writeMapping(obj.items())
+        elif isinstance(obj, (list, tuple)):
+            self.writeSequence(obj)
+        else:
+            self.__emit(json.dumps(obj))
+
+    def close(self):
+        self.flush()
+        if self.__compressor:
+            self.__send(self.__compressor.flush())
+        if self.__chunked:
+            self.__write(b"0\r\n\r\n")
@@ -0,0 +1,320 @@
+import re
+import json
+import heapq
+import base64
+import binascii
+from itertools import islice, chain
+from collections import Counter
+from bisect import bisect_left, bisect_right
+from MediaStore import MediaType
+
+"""
+search/filter/sort indexes over the library so a query only touches the rows it returns
+- an inverted index of the words in the name, show, episode and filename of every entry,
+  the words are also kept as a sorted vocabulary so a search term matches every word it
+  is the start of ("bre" finds "breaking") with a binary search
+- a set of entries per type, per show and per episode for the filters
+- a sorted (key, uuid) list per sort order, walked from the cursor until the page is full
+- a trigram index over the words for the fuzzy (typo tolerant) search
+the sorted lists are appended to while the library is changed and sorted again (nearly
+sorted, so it's cheap) by the first query after the change
+all methods are expected to be called under the library lock
+"""
+
+class TrigramIndex:
+    """
+    the words of the library by their trigrams, to find the words that are close to a search
+    term even when it's misspelled, the library has a lot less distinct words than it has entries
+    so this is kept over the words and the entries are found through the word postings
+    """
+
+    def __init__(self) -> None:
+        self.__words = {} # trigram -> {word}
+        self.__sizes = {} # word -> number of trigrams
+
+    @staticmethod
+    def trigrams(word):
+        padded = f"  {word} " # the start of a word counts more than its end
+        return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+    def add(self, word):
+        trigrams = self.trigrams(word)
+        self.__sizes[word] = len(trigrams)
+        for trigram in trigrams:
+            self.__words.setdefault(trigram, set()).add(word)
+
+    def remove(self, word):
+        self.__sizes.pop(word, None)
+        for trigram in self.trigrams(word):
+            words = self.__words.get(trigram)
+            if words is not None:
+                words.discard(word)
+                if not words:
+                    del self.__words[trigram]
+
+    def similar(self, term, limit, threshold):
+        """ [(word, similarity)] of the limit words most similar to term (dice coefficient of the trigrams) """
+        trigrams = self.trigrams(term)
+        shared = Counter(chain.from_iterable(self.__words.get(trigram, ()) for trigram in trigrams))
+
+        found = []
+        for word, count in shared.items():
+            similarity = 2 * count / (len(trigrams) + self.__sizes[word])
+            if similarity < 0.8 and word.startswith(term):
+                similarity = 0.8 # still typing
+            if similarity >= threshold:
+                found.append((word, similarity))
+        return heapq.nlargest(limit, found, key=lambda item: item[1])
+
+
+class LibraryIndex:
+    sortOrders = ('name', 'size', 'date')
+    similarWordsPerTerm = 20
+    similarityThreshold = 0.35
+    # words in more entries than this only add to the score of entries other terms already found
+    commonWordEntries = 5000
+    __wordRegex = re.compile(r"[^\W_]+")
+
+    class InvalidQuery(Exception):
+        pass
+
+    def __init__(self) -> None:
+        self.__postings = {}    # word -> {uuid}
+        self.__vocabulary = []  # sorted words of __postings
+        self.__vocabularyDirty = False
+        self.__trigrams = TrigramIndex() # over the words of __postings
+        self.__byType = {}      # MediaType -> {uuid}
+        self.__byShow = {}      # casefolded show -> {uuid}
+        self.__byEpisode = {}   # casefolded episode -> {uuid}
+        self.__keys = {}        # uuid -> sort keys
+        self.__sorted = {order: [] for order in self.sortOrders} # order -> [(key, uuid)]
+        self.__sortedDirty = False
+
+    @classmethod
+    def words(cls, text):
+        if not text:
+            return []
+        return cls.__wordRegex.findall(text.casefold())
+
+    @classmethod
+    def recordWords(cls, record):
+        words = set(cls.words(record.name))
+        words.update(cls.words(record.show))
+        words.update(cls.words(record.episode))
+        words.update(cls.words(record.file))
+        return words
+
+    @staticmethod
+    def sortKeys(record):
+        return (record.name.casefold(), record.size, record.mtime)
+
+    ########################################################################
+    # changing the index
+    ########################################################################
+
+    def add(self, uuid, record):
+        for word in self.recordWords(record):
+            uuids = self.__postings.get(word)
+            if uuids is None:
+                uuids = self.__postings[word] = set()
+                self.__vocabularyDirty = True
+                self.__trigrams.add(word)
+            uuids.add(uuid)
+
+        self.__byType.setdefault(record.type, set()).add(uuid)
+        if record.show:
+            self.__byShow.setdefault(record.show.casefold(), set()).add(uuid)
+        if record.episode:
+            self.__byEpisode.setdefault(record.episode.casefold(), set()).add(uuid)
+
+        keys = self.sortKeys(record)
+        self.__keys[uuid] = keys
+        for order, key in zip(self.sortOrders, keys):
+            self.__sorted[order].append((key, uuid))
+        self.__sortedDirty = True
+
+    def remove(self, uuid, record):
+        keys = self.__keys.pop(uuid)
+        for word in self.recordWords(record):
+            uuids = self.__postings[word]
+            uuids.discard(uuid)
+            if not uuids:
+                del self.__postings[word]
+                self.__vocabularyDirty = True
+                self.__trigrams.remove(word)
+
+        self.__discard(self.__byType, record.type, uuid)
+        if record.show:
+            self.__discard(self.__byShow, record.show.casefold(), uuid)
+        if record.episode:
+            self.__discard(self.__byEpisode, record.episode.casefold(), uuid)
+
+        self.__sort()
+        for order, key in zip(self.sortOrders, keys):
+            entries = self.__sorted[order]
+            del entries[bisect_left(entries, (key, uuid))]
+
+    @staticmethod
+    def __discard(index, key, uuid):
+        uuids = index.get(key)
+        if uuids is None:
+            return
+        uuids.discard(uuid)
+        if not uuids:
+            del index[key]
+
+    def __sort(self):
+        if self.__sortedDirty:
+            for entries in self.__sorted.values():
+                entries.sort()
+            self.__sortedDirty = False
+
+    def __words(self):
+        if self.__vocabularyDirty:
+            self.__vocabulary = sorted(self.__postings)
+            self.__vocabularyDirty = False
+        return self.__vocabulary
+
+    ########################################################################
+    # cursors
+    ########################################################################
+
+    @staticmethod
+    def encodeCursor(key, uuid):
+        return base64.urlsafe_b64encode(json.dumps([key, uuid]).encode()).decode()
+
+    @staticmethod
+    def decodeCursor(cursor):
+        try:
+            key, uuid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError, binascii.Error):
+            raise LibraryIndex.InvalidQuery(f"invalid cursor {cursor}")
+        if not isinstance(uuid, str) or not isinstance(key, (str, int, float)):
+            raise LibraryIndex.InvalidQuery(f"invalid cursor {cursor}")
+        return key, uuid
+
+    ########################################################################
+    # queries
+    ########################################################################
+
+    def __matchingText(self, text):
+        """ entries that have a word starting with every one of the search terms """
+        vocabulary = self.__words()
+        matching = None
+        for term in sorted(set(self.words(text)), key=len, reverse=True): # longest terms narrow it down the most
+            found = set()
+            index = bisect_left(vocabulary, term)
+            while index < len(vocabulary) and vocabulary[index].startswith(term):
+                found |= self.__postings[vocabulary[index]]
+                index += 1
+
+            matching = found if matching is None else matching & found
+            if not matching:
+                break
+        return matching
+
+    def __matching(self, text, mediaType, show, episode):
+        """ the entries matching all the filters, None if there are no filters """
+        candidates = []
+        if mediaType:
+            try:
+                candidates.append(self.__byType.get(MediaType(mediaType.capitalize()), set()))
+            except ValueError:
+                raise LibraryIndex.InvalidQuery(f"unknown type {mediaType}")
+        if show:
+            candidates.append(self.__byShow.get(show.casefold(), set()))
+        if episode:
+            # S01 is the whole season
+            episode = episode.casefold()
+            candidates.append(set().union(*(uuids for key, uuids in self.__byEpisode.items() if key.startswith(episode))))
+        if text and self.words(text):
+            candidates.append(self.__matchingText(text))
+
+        if not candidates:
+            return None
+
+        candidates.sort(key=len)
+        matching = set(candidates[0])
+        for uuids in candidates[1:]:
+            matching &= uuids
+        return matching
+
+    def query(self, text=None, mediaType=None, show=None, episode=None, sort='name', descending=False, cursor=None, limit=100):
+        """
+        returns (uuids of the page, cursor of the next page or None, number of matching entries)
+        """
+        if sort not in self.sortOrders:
+            raise LibraryIndex.InvalidQuery(f"unknown sort {sort}")
+        if limit <= 0:
+            raise LibraryIndex.InvalidQuery(f"invalid limit {limit}")
+
+        self.__sort()
+        matching = self.__matching(text, mediaType, show, episode)
+        entries = self.__sorted[sort]
+        total = len(entries) if matching is None else len(matching)
+
+        if matching is not None and len(matching) * 8 < len(entries):
+            # few matches, sorting them is cheaper than walking the whole order
+            keyIndex = self.sortOrders.index(sort)
+            entries = sorted((self.__keys[uuid][keyIndex], uuid) for uuid in matching)
+            matching = None
+
+        position = (len(entries) - 1) if descending else 0
+        if cursor:
+            after = self.decodeCursor(cursor)
+            try:
+                position = (bisect_left(entries, after) - 1) if descending else bisect_right(entries, after)
+            except TypeError:
+                raise LibraryIndex.InvalidQuery(f"cursor {cursor} is not for sort {sort}")
+
+        step = -1 if descending else 1
+        page = []
+        while 0 <= position < len(entries) and len(page) <= limit:
+            entry = entries[position]
+            if matching is None or entry[1] in matching:
+                page.append(entry)
+            position += step
+
+        nextCursor = None
+        if len(page) > limit:
+            page.pop()
+            nextCursor = self.encodeCursor(*page[-1])
+
+        return [uuid for _, uuid in page], nextCursor, total
+
+    def search(self, text, limit=20):
+        """
+        fuzzy search, returns [(uuid, score)] of the limit best matching entries, best first
+        every term of text scores the entries that have a word similar to it by the best similarity
+        of their words, entries that match more of the terms (and match them better) come first
+        """
+        if limit <= 0:
+            raise LibraryIndex.InvalidQuery(f"invalid limit {limit}")
+
+        matches = [] # (entries, similarity, term)
+        for term in set(self.words(text)):
+            similar = self.__trigrams.similar(term, self.similarWordsPerTerm, self.similarityThreshold)
+            if not similar:
+                continue
+            # typos are only looked for when there's nothing close, a term that is a word doesn't need them
+            cutoff = similar[0][1] * 0.75
+            matches += [(self.__postings[word], similarity, term) for word, similarity in similar if similarity >= cutoff]
+        matches.sort(key=lambda match: (len(match[0]), -match[1])) # rare words first
+
+        scores = {}
+        termScores = {} # term -> {uuid: best similarity}
+        for uuids, similarity, term in matches:
+            if len(uuids) > self.commonWordEntries:
+                # a word most of the library has can't tell entries apart, it only adds to the
+                # entries found by the other terms (or to a sample of them if there are none)
+                uuids = scores.keys() & uuids if scores else islice(uuids, self.commonWordEntries)
+            best = termScores.setdefault(term, {})
+            for uuid in uuids:
+                previous = best.get(uuid)
+                if previous is None or previous < similarity:
+                    best[uuid] = similarity
+                    scores[uuid] = scores.get(uuid, 0) + similarity - (previous or 0)
+
+        # on a tie the shorter name is the closer match
+        top = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -len(self.__keys[item[0]][0])))
+        return [(uuid, round(score, 3)) for uuid, score in top]
@@ -0,0 +1,185 @@
+import gzip
+import hashlib
+import threading
+from JsonStream import ChunkedJsonWriter
+from Shnoolog import Shnoolog
+
+logger = Shnoolog("LibraryPayload")
+
+"""
+the /list response serialized once per library version
+the first request after the library changed builds it, requests that come in meanwhile wait for
+that build instead of serializing the library again. gzip is compressed (once) the first time a
+client asks for it, the slower brotli and zstd variants are compressed in the background when the
+payload is stored and only offered once they're done (gzip or identity until then). every representation gets its own strong ETag so a client that already has it gets a 304 without
+anything being serialized or sent
+brotli and zstd are only offered when a module for them is installed, gzip is always there
+"""
+
+def _brotliCompressor():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return lambda data: brotli.compress(data, quality=LibraryPayloadCache.brotliQuality)
+
+def _zstdCompressor():
+    try:
+        from compression import zstd # python 3.14+
+        return lambda data: zstd.compress(data, level=LibraryPayloadCache.zstdLevel)
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return lambda data: zstandard.ZstdCompressor(level=LibraryPayloadCache.zstdLevel).compress(data)
+
+
+class LibraryPayload:
+    """ one version of the library as json, with its compressed variants """
+
+    def __init__(self, version, body) -> None:
+        self.version = version
+        self.tag = hashlib.sha1(body).hexdigest()
+        self.bodies = {'identity': body} # content coding -> bytes
+        self.__lock = threading.Lock()
+
+    def etag(self, encoding):
+        if encoding == 'identity':
+            return f'"{self.tag}"'
+        return f'"{self.tag}-{encoding}"'
+
+    def body(self, encoding, compress):
+        body = self.bodies.get(encoding)
+        if body is None:
+            # compressed outside of the lock, a slow coding doesn't hold up the others
+            body = compress(self.bodies['identity'])
+            with self.__lock:
+                body = self.bodies.setdefault(encoding, body)
+        return body
+
+
+class LibraryPayloadCache:
+    gzipLevel = 6
+    brotliQuality = 9
+    zstdLevel = 10
+    onDemand = frozenset(('gzip',)) # fast enough to compress on the request thread
+
+    def __init__(self, library) -> None:
+        self.library = library
+        self.__payload = None
+        self.__lock = threading.Lock()
+        self.__buildLock = threading.Lock() # one build at a time, the others wait for it
+        self.compressors = {'gzip': lambda data: gzip.compress(data, compresslevel=self.gzipLevel, mtime=0)}
+        brotli = _brotliCompressor()
+        if brotli:
+            self.compressors['br'] = brotli
+        zstd = _zstdCompressor()
+        if zstd:
+            self.compressors['zstd'] = zstd
+        # best first, when the client accepts a few with the same q value
+        self.preference = [encoding for encoding in ('zstd', 'br', 'gzip') if encoding in self.compressors] + ['identity']
+
+    def current(self):
+        """ the payload of the current library version, None if it wasn't built yet """
+        payload = self.__payload
+        if payload and payload.version == self.library.version:
+            return payload
+        return None
+
+    def get(self):
+        """ the payload of the current library version, built if it wasn't yet """
+        payload = self.current()
+        if payload:
+            return payload
+        with self.__buildLock:
+            payload = self.current()
+            if payload:
+                return payload # built while this one waited
+            version, entries = self.library.entries()
+            body = []
+            writer = ChunkedJsonWriter(lambda data: None, chunked=False, tee=body)
+            writer.writeMapping(entries)
+            writer.close()
+            return self.store(version, b"".join(body))
+
+    def store(self, version, body):
+        """
+        body: the json of the library at version
+        returns the cached payload, the one already there if someone else got here first
+        """
+        with self.__lock:
+            if self.__payload and self.__payload.version >= version:
+                return self.__payload # someone else got here first, or it's already outdated
+            payload = self.__payload = LibraryPayload(version, body)
+        logger.info(f"Library payload for version {version} cached, {len(body)/1024/1024:.2f} MiBi")
+        if any(encoding not in self.onDemand for encoding in self.compressors):
+            threading.Thread(target=self.__compress, args=(payload,), name="LibraryPayload", daemon=True).start()
+        return payload
+
+    def __compress(self, payload):
+        for encoding in self.preference:
+            if encoding == 'identity' or encoding in self.onDemand:
+                continue
+            if self.__payload is not payload:
+                return # the library changed, no one is going to ask for these
+            try:
+                self.body(payload, encoding)
+            except Exception as e:
+                logger.error(f"Failed to compress the library payload with {encoding}: {e}")
+
+    def codings(self, payload):
+        """ the codings payload can be sent with right away """
+        return [encoding for encoding in self.compressors if encoding in self.onDemand or encoding in payload.bodies]
+
+    def negotiate(self, acceptEncoding, codings=None):
+        """
+        the content coding to answer with for an Accept-Encoding header
+        codings: limit the choice to these (i.e. the ones that can be streamed)
+        """
+        preference = [coding for coding in self.preference if codings is None or coding in codings or coding == 'identity']
+        if not acceptEncoding:
+            return 'identity'
+
+        accepted = {}
+        for item in acceptEncoding.split(','):
+            coding, _, params = item.strip().partition(';')
+            coding = coding.strip().lower()
+            quality = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            if coding:
+                accepted[coding] = quality
+
+        def qualityOf(coding):
+            if coding in accepted:
+                return accepted[coding]
+            if coding == 'identity':
+                return accepted.get('*', 1.0) # always acceptable unless refused
+            return accepted.get('*', 0.0)
+
+        best = max(preference, key=lambda coding: (qualityOf(coding), -preference.index(coding)))
+        if qualityOf(best) <= 0:
+            return 'identity' # nothing acceptable, identity is still the best we can do
+        return best
+
+    def body(self, payload, encoding):
+        if encoding == 'identity':
+            return payload.bodies['identity']
+        return payload.body(encoding, self.compressors[encoding])
+
+    @staticmethod
+    def matches(ifNoneMatch, etag):
+        """ If-None-Match uses the weak comparison """
+        if not ifNoneMatch:
+            return False
+        for tag in ifNoneMatch.split(','):
+            tag = tag.strip()
+            if tag == '*' or tag.removeprefix('W/') == etag:
+                return True
+        return False
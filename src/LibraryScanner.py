@@ -0,0 +1,185 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from Shnoolog import Shnoolog
+
+logger = Shnoolog("LibraryScanner")
+
+"""
+concurrent directory walker for the media library
+every media path (mount) gets its own bounded thread pool that lists directories
+with os.scandir, sub directories are submitted back to the same pool as soon as they
+are found so independent subtrees are listed in parallel (which matters on NAS mounts
+where every listing/stat is a network round trip)
+the listings are then handed back in the exact order os.walk would have yielded them
+so the library built from them is the same as a serial scan
+"""
+
+class ScannedDir:
+    __slots__ = ('root', 'mtime', 'dirs', 'media', 'subtitles', 'derived')
+
+    def __init__(self, root, mtime=None) -> None:
+        self.root = root
+        self.mtime = mtime  # st_mtime_ns of the directory, only taken when a manifest is used
+        self.dirs = []      # sub directories to walk into (symlinks are not followed, same as os.walk)
+        self.media = []     # (filename, os.stat_result taken from the DirEntry or a FileStat)
+        self.subtitles = [] # filenames
+        self.derived = None # deriveMedia results for media, when restored from the manifest
+
+
+class FileStat:
+    """ the part of os.stat_result the library uses, for files restored from the manifest """
+    __slots__ = ('st_size', 'st_mtime', 'st_ctime', 'st_ino', 'st_mtime_ns')
+
+    def __init__(self, size, mtime, ctime, ino, mtimeNS) -> None:
+        self.st_size = size
+        self.st_mtime = mtime
+        self.st_ctime = ctime
+        self.st_ino = ino
+        self.st_mtime_ns = mtimeNS
+
+
+# process pool workers get their own copy of the library once, instead of
+# pickling it with every chunk of work
+_deriveLibrary = None
+
+def _initDeriveWorker(library):
+    global _deriveLibrary
+    _deriveLibrary = library
+
+def _deriveChunk(chunk):
+    return [_deriveLibrary.deriveMedia(*job) for job in chunk]
+
+
+class LibraryScanner:
+    # below this amount of media files spinning up worker processes costs more than it saves
+    parallelDeriveThreshold = 5000
+    deriveChunkSize = 500
+
+    def __init__(self, isMediaFile, isSubtitleFile, workers=8, processes=0, manifest=None) -> None:
+        self.isMediaFile = isMediaFile
+        self.isSubtitleFile = isSubtitleFile
+        self.manifest = manifest
+        self.workers = max(1, workers)
+        self.processes = processes if processes > 0 else (os.cpu_count() or 1)
+
+    def restoreDir(self, mediaPath, path):
+        """ returns the listing of path from the manifest, or (None, mtime) if it has changed """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None, None
+
+        entry = self.manifest.lookup(mediaPath, path, mtime)
+        if not entry:
+            return None, mtime
+
+        listing = ScannedDir(path, mtime)
+        listing.dirs = entry['dirs']
+        listing.subtitles = entry['subtitles']
+        listing.derived = []
+        for file, size, fileMtime, ctime, ino, mtimeNS, derived in entry['media']:
+            listing.media.append((file, FileStat(size, fileMtime, ctime, ino, mtimeNS)))
+            listing.derived.append(derived)
+        return listing, mtime
+
+    def listDir(self, mediaPath, path):
+        mtime = None
+        if self.manifest:
+            listing, mtime = self.restoreDir(mediaPath, path)
+            if listing:
+                return listing
+
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            return None # os.walk ignores unreadable directories as well
+
+        listing = ScannedDir(path, mtime)
+        for entry in entries:
+            try:
+                isDir = entry.is_dir()
+            except OSError:
+                isDir = False
+
+            if isDir:
+                try:
+                    isLink = entry.is_symlink()
+                except OSError:
+                    isLink = False
+                if not isLink:
+                    listing.dirs.append(entry.name)
+                continue
+
+            file = entry.name
+            if self.isSubtitleFile(file):
+                listing.subtitles.append(file)
+                continue
+
+            if not self.isMediaFile(file):
+                continue
+
+            try:
+                fileStats = entry.stat() # cached on the entry, no second stat later on
+            except OSError as e:
+                logger.warning(f"Failed to stat {entry.path}, skipped. {e}")
+                continue
+            listing.media.append((file, fileStats))
+
+        return listing
+
+    def walk(self, mediaPaths):
+        """
+        list all the media paths concurrently
+        returns a list of (mediaPath, ScannedDir) in os.walk top-down order
+        """
+        listings = [{} for _ in mediaPaths]
+        pools = []
+        pending = {}
+        try:
+            for index, mediaPath in enumerate(mediaPaths):
+                logger.info(f"Scanning media path: {mediaPath}")
+                pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"scan{index}")
+                pools.append(pool)
+                pending[pool.submit(self.listDir, mediaPath, mediaPath)] = (index, pool)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, pool = pending.pop(future)
+                    listing = future.result()
+                    if listing is None:
+                        continue
+                    listings[index][listing.root] = listing
+                    for dirname in listing.dirs:
+                        pending[pool.submit(self.listDir, mediaPaths[index], os.path.join(listing.root, dirname))] = (index, pool)
+        finally:
+            for pool in pools:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+        ordered = []
+        for index, mediaPath in enumerate(mediaPaths):
+            stack = [mediaPath]
+            while stack:
+                listing = listings[index].get(stack.pop())
+                if listing is None:
+                    continue
+                ordered.append((mediaPath, listing))
+                stack.extend(os.path.join(listing.root, dirname) for dirname in reversed(listing.dirs))
+
+        return ordered
+
+    def derive(self, library, jobs):
+        """
+        run library.deriveMedia on every job (the sanitizing part of the scan is pure cpu)
+        big libraries are spread over a process pool, results keep the order of jobs
+        """
+        if self.processes <= 1 or len(jobs) < self.parallelDeriveThreshold:
+            return [library.deriveMedia(*job) for job in jobs]
+
+        chunks = [jobs[i:i+self.deriveChunkSize] for i in range(0, len(jobs), self.deriveChunkSize)]
+        results = []
+        with ProcessPoolExecutor(max_workers=self.processes, initializer=_initDeriveWorker, initargs=(library,)) as pool:
+            for chunk in pool.map(_deriveChunk, chunks):
+                results.extend(chunk)
+        return results
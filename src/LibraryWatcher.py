@@ -0,0 +1,194 @@
+import os
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+import threading
+import time
+from MediaLibrary import MediaLibrary
+from Shnoolog import Shnoolog
+
+"""
+keeps the library up to date while the server runs using linux inotify (through ctypes, no extra modules)
+every directory found by the scan gets a watch, events are collected and only applied to the library
+once things are quiet for a bit, so copying a whole season in costs one batched update and not one per file
+"""
+
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_ISDIR        = 0x40000000
+IN_NONBLOCK     = 0x00000800
+IN_CLOEXEC      = 0x00080000
+
+class LibraryWatcher:
+    __watchMask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+    __eventHeader = struct.Struct("iIII") # wd, mask, cookie, len
+    __readSize = 64 * 1024
+
+    def __init__(self, library: MediaLibrary, batchDelaySeconds=2, maxBatchDelaySeconds=30) -> None:
+        self.logger = Shnoolog("LibraryWatcher")
+        self.library = library
+        self.batchDelaySeconds = batchDelaySeconds
+        self.maxBatchDelaySeconds = maxBatchDelaySeconds # apply a batch even if events keep coming
+        self.__fd = -1
+        self.__libc = None
+        self.__watches = {} # wd -> (mediaPath, directory)
+        self.__pending = {} # path -> (mediaPath, MediaLibrary.Change), latest change wins
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__outOfWatches = False
+
+    def start(self) -> bool:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        except (OSError, AttributeError) as e:
+            self.logger.logWarn(f"inotify is not available, library won't be updated while running. {e}")
+            return False
+
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            self.logger.logWarn(f"Failed to init inotify: {os.strerror(ctypes.get_errno())}, library won't be updated while running")
+            return False
+
+        self.__libc = libc
+        self.__fd = fd
+        for mediaPath, directory in self.library.scannedDirectories:
+            self.__addWatch(mediaPath, directory)
+
+        self.__thread = threading.Thread(target=self.__run, name="LibraryWatcher", daemon=True)
+        self.__thread.start()
+        self.logger.logInfo(f"Watching {len(self.__watches)} library directories for changes")
+        return True
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+
+    ########################################################################
+    # watches
+    ########################################################################
+
+    def __addWatch(self, mediaPath, directory):
+        wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(directory), self.__watchMask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC and not self.__outOfWatches:
+                self.__outOfWatches = True
+                self.logger.logWarn("Ran out of inotify watches, some directories won't be updated (raise fs.inotify.max_user_watches)")
+            elif err != errno.ENOSPC:
+                self.logger.warning(f"Failed to watch {directory}: {os.strerror(err)}")
+            return
+        self.__watches[wd] = (mediaPath, directory)
+
+    def __removeWatchesUnder(self, directory):
+        prefix = directory.rstrip(os.sep) + os.sep
+        for wd, (_, watched) in list(self.__watches.items()):
+            if watched == directory or watched.startswith(prefix):
+                self.__libc.inotify_rm_watch(self.__fd, wd)
+                del self.__watches[wd]
+
+    ########################################################################
+    # events
+    ########################################################################
+
+    def __queue(self, mediaPath, path, change):
+        self.__pending.pop(path, None) # keep the order of the latest change
+        self.__pending[path] = (mediaPath, change)
+
+    def __processEvents(self, data):
+        offset = 0
+        while offset + self.__eventHeader.size <= len(data):
+            wd, mask, _, nameLength = self.__eventHeader.unpack_from(data, offset)
+            offset += self.__eventHeader.size
+            name = os.fsdecode(data[offset:offset+nameLength].rstrip(b'\0'))
+            offset += nameLength
+
+            if mask & IN_Q_OVERFLOW:
+                self.logger.warning("inotify queue overflowed, syncing all media paths")
+                for mediaPath in self.library.mediaPaths:
+                    self.__queue(mediaPath, mediaPath, MediaLibrary.Change.DIR_ADDED)
+                continue
+
+            if mask & IN_IGNORED:
+                self.__watches.pop(wd, None)
+                continue
+
+            watch = self.__watches.get(wd)
+            if not watch or not name:
+                continue # *_SELF events, the parent directory reports these as well
+
+            mediaPath, directory = watch
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.__addWatch(mediaPath, path) # right away so files written into it are not missed
+                    self.__queue(mediaPath, path, MediaLibrary.Change.DIR_ADDED)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    # watches follow the directory inode, a moved directory will be watched again under its new name
+                    self.__removeWatchesUnder(path)
+                    self.__queue(mediaPath, path, MediaLibrary.Change.DIR_REMOVED)
+                continue
+
+            # a file created with IN_CREATE is still being written to, wait for IN_CLOSE_WRITE
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.__queue(mediaPath, path, MediaLibrary.Change.FILE_ADDED)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.__queue(mediaPath, path, MediaLibrary.Change.FILE_REMOVED)
+
+    def __applyPending(self):
+        changes = [(mediaPath, path, change) for path, (mediaPath, change) in self.__pending.items()]
+        self.__pending = {}
+        try:
+            addedDirectories = self.library.applyChanges(changes)
+        except Exception as e:
+            self.logger.error(f"Failed to apply file system changes to the library: {e}")
+            return
+
+        watched = set(directory for _, directory in self.__watches.values())
+        for mediaPath, directory in addedDirectories:
+            if directory not in watched:
+                self.__addWatch(mediaPath, directory)
+
+    def __run(self):
+        firstEvent = None
+        lastEvent = None
+        while not self.__stop.is_set():
+            timeout = 1
+            if lastEvent is not None:
+                timeout = max(0, min(lastEvent + self.batchDelaySeconds, firstEvent + self.maxBatchDelaySeconds) - time.monotonic())
+
+            readable, _, _ = select.select([self.__fd], [], [], timeout)
+            if readable:
+                try:
+                    data = os.read(self.__fd, self.__readSize)
+                except BlockingIOError:
+                    data = b''
+                if data:
+                    self.__processEvents(data)
+                    lastEvent = time.monotonic()
+                    if firstEvent is None:
+                        firstEvent = lastEvent
+                if firstEvent is None or time.monotonic() - firstEvent < self.maxBatchDelaySeconds:
+                    continue
+
+            if self.__pending:
+                self.__applyPending()
+            firstEvent = None
+            lastEvent = None
@@ -3,12 +3,23 @@ import re
 import json
 import time
 import uuid
+import threading
+from enum import Enum
+from collections import namedtuple
+from LibraryScanner import LibraryScanner
+from ScanManifest import ScanManifest
+from MediaStore import MediaStore
+from LibraryIndex import LibraryIndex
+from ShowIndex import ShowIndex
 from Shnoolog import Shnoolog
 
 logger = Shnoolog("MediaLibrary")
 
+def filenameWords(stem):
+    """ the parts of a filename (without its extension) between . - _, the tokens a language code is looked for in """
+    return stem.replace("-", ".").replace("_", ".").split(".")
+
 class SubtitleCache:
-    __cache = {}
     __langs = {
         'eng':'English',
         'spa':'Latin America Spanish',
@@ -59,94 +70,149 @@ class SubtitleCache:
         'chi':'中文',
         }
 
-    __splitReg = re.compile("[\.\-\_]")
+    """
+    subtitles are indexed by the absolute directory they are in and by every parent directory
+    up to the media path they were found in, so a media file finds the subtitles next to it and in
+    any sub directory of its own directory (i.e. Subs/), inside a directory they are grouped by filename
+    stem (default subtitles) and the ones with a known language are kept with their language label
+    """
+    class Directory:
+        __slots__ = ('byStem', 'labelled')
 
-    def __init__(self) -> None:
-        pass
-
-    def __add(self, key, val):
-        if key not in self.__cache:
-            self.__cache[key] = []
-        self.__cache[key].append(val)
-
-    def __keyFromPath(self, filepath, file):
-        if filepath == file:
-            return os.sep
-        return os.sep+filepath.replace(os.sep+file,"")
-
-    def __getLanguage(self, subtitle):
-        components = self.__splitReg.split(subtitle)
-        for c in components:
-            if c in self.__langs:
-                return self.__langs[c]
-        return None
+        def __init__(self) -> None:
+            self.byStem = {}   # stem -> [subtitle paths]
+            self.labelled = {} # subtitle path -> (language label, stem)
 
+    def __init__(self) -> None:
+        self.__dirs = {}      # absolute directory -> SubtitleCache.Directory
+        self.__subtitles = {} # absolute subtitle path -> directories it's indexed under
 
-    def addSubtitle(self, filepath, absFilePath):
-        file  = os.path.basename(absFilePath)
-        pathKey = self.__keyFromPath(filepath,file)
-        if len(pathKey) == 0:
-            logger.warning("attempting to insert empty key to SubtitleCache, skipped")
-            return
+    def __getLanguage(self, words):
+        for word in words:
+            if word in self.__langs:
+                return self.__langs[word]
+        return None
 
-        if pathKey == os.sep:
-            self.__add(pathKey, absFilePath)
+    def __directoriesOf(self, absFilePath, mediaPath):
+        root = mediaPath.rstrip(os.sep) or os.sep
+        rootPrefix = root.rstrip(os.sep) + os.sep
+        directory = os.path.dirname(absFilePath)
+        directories = [directory]
+        while directory.startswith(rootPrefix):
+            parent = os.path.dirname(directory)
+            if parent == directory or parent == root:
+                break
+            directory = parent
+            directories.append(directory)
+        return directories
+
+    def addSubtitle(self, absFilePath, mediaPath):
+        if absFilePath in self.__subtitles:
+            self.removeSubtitle(absFilePath)
+
+        subname, _ = os.path.splitext(os.path.basename(absFilePath))
+        label = self.__getLanguage(filenameWords(subname))
+        directories = self.__directoriesOf(absFilePath, mediaPath)
+        for directory in directories:
+            entry = self.__dirs.get(directory)
+            if entry is None:
+                entry = self.__dirs[directory] = SubtitleCache.Directory()
+            entry.byStem.setdefault(subname, []).append(absFilePath)
+            if label:
+                entry.labelled[absFilePath] = (label, subname)
+        self.__subtitles[absFilePath] = directories
+
+    def removeSubtitle(self, absFilePath):
+        directories = self.__subtitles.pop(absFilePath, None)
+        if not directories:
             return
 
-        components = [c for c in pathKey.split(os.sep) if c != '']
-
-        for c in components:
-            self.__add(c, absFilePath)
-
-    def getSubtitles(self, filepath, file, fullPaths=True):
-        pathKey = self.__keyFromPath(filepath,file)
-        if len(pathKey) == 0:
+        subname, _ = os.path.splitext(os.path.basename(absFilePath))
+        for directory in directories:
+            entry = self.__dirs.get(directory)
+            if entry is None:
+                continue
+            paths = entry.byStem.get(subname, [])
+            if absFilePath in paths:
+                paths.remove(absFilePath)
+            if not paths:
+                entry.byStem.pop(subname, None)
+            entry.labelled.pop(absFilePath, None)
+            if not entry.byStem:
+                del self.__dirs[directory]
+
+    def removeSubtitlesUnder(self, absDirPath):
+        prefix = absDirPath.rstrip(os.sep) + os.sep
+        for absFilePath in [p for p in self.__subtitles if p.startswith(prefix)]:
+            self.removeSubtitle(absFilePath)
+
+    def getSubtitles(self, absMediaPath, fullPaths=True):
+        """
+        subtitles for a media file, a subtitle with the same name as the media file comes first as 'default'
+        then the subtitles with a known language [{'default': path}, {'English': path}, ...]
+        """
+        entry = self.__dirs.get(os.path.dirname(absMediaPath))
+        if entry is None:
             return []
 
-        if pathKey != os.sep:
-            pathKey = os.path.basename(pathKey)
+        filename, _ = os.path.splitext(os.path.basename(absMediaPath))
 
-        if pathKey not in self.__cache:
-            return []
+        def returnedFilename(subtitleFile):
+            return subtitleFile if fullPaths else os.path.basename(subtitleFile)
 
-        filename, _ = os.path.splitext(file)
-        subtitles = self.__cache[pathKey]
+        retSubtitles = [{'default': returnedFilename(subtitleFile)} for subtitleFile in reversed(entry.byStem.get(filename, []))]
+        for subtitleFile, (lang, subname) in entry.labelled.items():
+            if subname != filename:
+                retSubtitles.append({lang: returnedFilename(subtitleFile)})
 
-        retSubtitles = []
-        for subtitleFile in subtitles:
-            returnedFilename = subtitleFile
-            subtitleFilename = os.path.basename(subtitleFile)
+        return retSubtitles
 
-            if not fullPaths:
-                returnedFilename = subtitleFilename
 
-            subname, _ =  os.path.splitext(subtitleFilename)
-            if subname == filename:
-                retSubtitles.insert(0, {'default': returnedFilename})
-                continue
-            lang = self.__getLanguage(subname)
-            if lang:
-                retSubtitles.append({lang: returnedFilename})
+# everything derived from a single filename, see MediaLibrary.tokenizeFilename
+FilenameTokens = namedtuple('FilenameTokens', ['name', 'tokens', 'episode', 'lang'])
 
-        return retSubtitles
+class MediaLibrary:
 
+    class Change(Enum):
+        FILE_ADDED='file_added'     # new file or a file that was written to
+        FILE_REMOVED='file_removed'
+        DIR_ADDED='dir_added'       # new directory, or a directory that needs to be synced again
+        DIR_REMOVED='dir_removed'
 
-class MediaLibrary:
-    __subtitleCache = SubtitleCache()
+    __idNamespace = uuid.UUID('5d0f6a43-8a4e-4f0c-9d43-6e6f6f646c65')
+    dirWordCloudCacheSize = 1024 # directories, files of a directory are scanned together so this can be small
 
-    def __init__(self, paths, allowedMediaExt, allowedSubtitleExt, blacklistPath, patches):
+    def __init__(self, paths, allowedMediaExt, allowedSubtitleExt, blacklistPath, patches, scanWorkers=8, scanProcesses=0, manifestPath=None):
         self.mediaPaths = paths
-        self.absPathFromUUID = {}
-        self.media = {}
+        self.media = MediaStore() # uuid -> entry, read only mapping use the library methods to change it
+        self.absPathFromUUID = self.media.absPaths
+        self.index = LibraryIndex() # search/filter/sort indexes over media for query
+        self.showIndex = ShowIndex() # show -> season -> episodes
+        self.__subtitleCache = SubtitleCache()
+        self.__dirWordClouds = {} # relative directory -> (word cloud, number of components), only kept during a scan
+        self.scannedDirectories = [] # (mediaPath, directory) of every directory found by the scan
+        self.lock = threading.RLock() # held while the library is changed
+        self.version = 0 # goes up every time the library changes
         self.allowedExt = allowedMediaExt
         self.allowedSubtitleExt = allowedSubtitleExt
         self.episodeRegex = re.compile("[Ss][0-9]{1,2}[Ee][0-9]{1,2}")
+        self.episodeSplitRegex = re.compile("([Ss][0-9]{1,2}[Ee][0-9]{1,2})") # split keeps the episode numbers
         self.showRegex = re.compile("[Ss][0-9]{1,2}")
         self.langList = [ "eng", "jpn", "ita", "spa"] #probably more
+        # the ways a language can show up in a filename, eng: eng ENG en EN Eng
+        self.langVariations = [(lang, (lang.lower(), lang.upper(), lang[0:2].lower(), lang[0:2].upper(), lang[0:1].upper()+lang[1:]))
+                               for lang in self.langList]
+        self.langOfVariation = {}
+        for lang, variations in reversed(self.langVariations): # the first language of a variation wins
+            self.langOfVariation.update((variation, lang) for variation in variations)
+        self.langRegex = re.compile(self.wordsPattern(self.langOfVariation))
         self.p1Regex = re.compile("\([^\)]+\)")
         self.p2Regex = re.compile("\[[^\]]+\]")
         self.p3Regex = re.compile("\{[^\}]+\}")
         self.patches = patches
+        self.scanWorkers = scanWorkers
+        self.scanProcesses = scanProcesses
+        self.manifestPath = manifestPath
 
         self.blacklist = []
         self.compoundBlacklist = [] # blacklist that should be removed before tokenizing
@@ -164,6 +230,55 @@ class MediaLibrary:
                 example = "{ \"blacklist\" : \[ 'a','b' \], \"compound_blacklist\" : \[ 'a b', 'ba' \] }"
                 logger.error(f"Empty words blacklist in MediaLibrary, to add one crete a {blacklistPath} json file: {example}")
 
+        # compiled once, sanitize runs for every file and every directory name
+        self.blacklistTokens = frozenset(self.blacklist)
+        compoundWords = [word for word in self.compoundBlacklist if word]
+        self.compoundBlacklistRegex = None
+        if compoundWords:
+            self.compoundBlacklistRegex = re.compile(self.wordsPattern(compoundWords))
+
+    @staticmethod
+    def wordsPattern(words):
+        """
+        regex matching any of words, the longest one where a few start at the same place
+        the words are arranged in a trie (i.e. (?:H.26(?:4|5)|DD(?:P5.1|5.1))) so the regex engine follows
+        one branch per character instead of trying every word at every position of the string
+        """
+        trie = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[''] = None # a word ends here
+
+        def pattern(node):
+            # longer words first, the end of a word is the last (empty) alternative
+            alternatives = [re.escape(char) + pattern(child) for char, child in node.items() if char]
+            if '' in node and alternatives:
+                alternatives.append('')
+            if len(alternatives) == 1:
+                return alternatives[0]
+            return "(?:" + "|".join(alternatives) + ")" if alternatives else ""
+
+        return pattern(trie)
+
+    def __getstate__(self):
+        # scan worker processes only need what it takes to derive records, not the entries
+        state = self.__dict__.copy()
+        del state['lock']
+        state['media'] = MediaStore()
+        state['absPathFromUUID'] = state['media'].absPaths
+        state['index'] = LibraryIndex()
+        state['showIndex'] = ShowIndex()
+        state['_MediaLibrary__dirWordClouds'] = {}
+        state['_MediaLibrary__subtitleCache'] = SubtitleCache()
+        state['scannedDirectories'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
     def isMediaFile(self, path):
         path, ext = os.path.splitext(path)
         ext = ext[1:].lower()
@@ -175,18 +290,18 @@ class MediaLibrary:
         return ext in self.allowedSubtitleExt
 
     def extractLang(self, filename):
-        # find strings like en jpn ita etc.
-        variations = []
-        for lang in self.langList:
-            variations.append(lang.lower())
-            variations.append(lang.upper())
-            variations.append(lang[0:2].lower())
-            variations.append(lang[0:2].upper())
-            variations.append(lang[0:1].upper()+lang[1:])
+        # find strings like en jpn ita etc. the first language of langList that shows up anywhere in filename.
+        # one regex pass finds the ones that show up, a language before the best one found can only be
+        # hidden by an overlapping match so just those are looked for again
+        found = self.langRegex.findall(filename)
+        if not found:
+            return ""
+        best = min(self.langList.index(self.langOfVariation[variation]) for variation in found)
+        for lang, variations in self.langVariations[:best]:
             for v in variations:
                 if v in filename:
                     return lang
-        return ""
+        return self.langList[best]
 
     def extractEpisodeNumber(self, filename):
         # episode numbering S[0-9]{1,2}E[0-9]{1,2}
@@ -195,6 +310,23 @@ class MediaLibrary:
             return ""
         return episodeDetails[0]
 
+    def __wordCloud(self, pathComponents):
+        wordCloud = {}
+        for component in pathComponents:
+            for part in set(self.nameTokens(component)): # remove duplicates
+                wordCloud[part] = wordCloud.get(part, 0) + 1
+        return wordCloud
+
+    def __directoryWordCloud(self, dirPath):
+        """ the word cloud of a directory is the same for every file in it, so it's only built once """
+        cached = self.__dirWordClouds.get(dirPath)
+        if cached is None:
+            pathComponents = [c for c in dirPath.split(os.sep) if c != '']
+            if len(self.__dirWordClouds) >= self.dirWordCloudCacheSize:
+                del self.__dirWordClouds[next(iter(self.__dirWordClouds))]
+            cached = self.__dirWordClouds[dirPath] = (self.__wordCloud(pathComponents), len(pathComponents))
+        return cached
+
     """
     look at all path components of filepath
     sanitize each of them
@@ -202,41 +334,45 @@ class MediaLibrary:
     go over the properName argument and give each word it's count in the word cloud
     remove any words from properName that appear the least
     assume that what is left is the show name
+    fileTokens are the tokens of the filename (last component of filepath), when given the
+    word cloud of the directory is taken from a per directory cache
     """
-    def extractShowName(self, filepath, properName):
+    def extractShowName(self, filepath, properName, fileTokens=None):
 
-        def buildStringFromWordCloud(wordCloud, str, threshold):
+        def buildStringFromWordCloud(wordCloud, fileWords, str, threshold):
             ret = []
             if threshold <= 0:
                 threshold = 1
             strComps = [c for c in str.split(" ") if c != '']
             for strComp in strComps:
                 count = wordCloud.get(strComp, 0)
+                if strComp in fileWords:
+                    count += 1
                 if count >= threshold:
                     ret.append(strComp)
             ret = " ".join(list(dict.fromkeys(ret))) # unique filtering and preserving order
             return ret
 
-
-        pathComponents = [c for c in filepath.split(os.sep) if c != '']
-        pathComponentsLen = len(pathComponents)
-        wordCloud = {}
-        for component in pathComponents:
-            cleanComponent = self.sanitizeFilename(component)
-            parts = set([c for c in cleanComponent.split(" ") if c != '']) # remove duplicates
-            for part in parts:
-                wordCloud[part] = wordCloud.get(part, 0) + 1
-
+        if fileTokens is not None:
+            dirPath, _, _ = filepath.rpartition(os.sep)
+            wordCloud, dirComponentsLen = self.__directoryWordCloud(dirPath)
+            fileWords = set(fileTokens.tokens)
+            pathComponentsLen = dirComponentsLen + 1
+        else:
+            pathComponents = [c for c in filepath.split(os.sep) if c != '']
+            wordCloud = self.__wordCloud(pathComponents)
+            fileWords = ()
+            pathComponentsLen = len(pathComponents)
 
         padding = 0
         if pathComponentsLen > 2:
             padding = 1
 
-        assumedShowName = buildStringFromWordCloud(wordCloud=wordCloud, str=properName, threshold=pathComponentsLen-padding)
+        assumedShowName = buildStringFromWordCloud(wordCloud=wordCloud, fileWords=fileWords, str=properName, threshold=pathComponentsLen-padding)
 
         # let's be a bit less strict
         if len(assumedShowName) == 0:
-            assumedShowName = buildStringFromWordCloud(wordCloud=wordCloud, str=properName, threshold=pathComponentsLen-(padding*2))
+            assumedShowName = buildStringFromWordCloud(wordCloud=wordCloud, fileWords=fileWords, str=properName, threshold=pathComponentsLen-(padding*2))
 
         # give up
         if len(assumedShowName) == 0:
@@ -255,33 +391,33 @@ class MediaLibrary:
         return self.showRegex.sub("", filename)
 
     def inBlacklist(self, str):
-        for word in self.blacklist:
-            if str == word:
-                return True
-        return False
+        return str in self.blacklistTokens
 
     def sanitize(self, str):
-        str = self.p1Regex.sub("", str)
-        str = self.p2Regex.sub("", str)
-        str = self.p3Regex.sub("", str)
-
-        for word in self.compoundBlacklist:
-            str = str.replace(word, "")
-
-        sep = " "
-        str = re.sub(r"[\.\-_\s]+",sep,str)
-
-        tokens = str.split(sep)
-
-        newStr = ""
-        for token in tokens:
-            if not token:
-                continue
-
-            if not token in self.blacklist:
-                newStr  = newStr + " " + token
-
-        return newStr.strip()
+        return " ".join(self.sanitizeTokens(str))
+
+    def sanitizeTokens(self, str):
+        # a name without an opening bracket doesn't need a regex pass to find out
+        if "(" in str:
+            str = self.p1Regex.sub("", str)
+        if "[" in str:
+            str = self.p2Regex.sub("", str)
+        if "{" in str:
+            str = self.p3Regex.sub("", str)
+
+        # all compound words are removed in one regex pass (longest first where they overlap),
+        # removing a word can join the parts around it into another word from the list so it's
+        # repeated until nothing is removed
+        if self.compoundBlacklistRegex:
+            removed = 1
+            while removed:
+                str, removed = self.compoundBlacklistRegex.subn("", str)
+
+        # . - _ and whitespace separate the words (split() without a separator drops the empty ones)
+        str = str.replace(".", " ").replace("-", " ").replace("_", " ")
+
+        blacklistTokens = self.blacklistTokens
+        return [token for token in str.split() if token not in blacklistTokens]
 
     """
     sanitize order
@@ -290,11 +426,35 @@ class MediaLibrary:
     all the words inside the words bucket
     """
     def sanitizeFilename(self, path):
+        return " ".join(self.nameTokens(path))
+
+    def nameTokens(self, path):
+        """ the words sanitizeFilename keeps from path """
         path, ext = os.path.splitext(path)
 
         path = self.sanitizeEpisodeNumbers(path)
 
-        return self.sanitize(path)
+        return self.sanitizeTokens(path)
+
+    def tokenizeFilename(self, file) -> FilenameTokens:
+        """
+        everything the library derives from a filename: the sanitized name and its tokens, the episode
+        number (S01E01) and the language
+        same results as sanitizeFilename, extractEpisodeNumber and extractLang
+        """
+        stem, ext = os.path.splitext(file)
+
+        # one pass both finds the episode numbers and removes them from the name
+        parts = self.episodeSplitRegex.split(stem)
+        episode = ""
+        if len(parts) > 1:
+            episode = parts[1]
+            stem = "".join(parts[0::2])
+        elif ext:
+            episode = self.extractEpisodeNumber(ext)
+
+        tokens = self.sanitizeTokens(stem)
+        return FilenameTokens(" ".join(tokens), tokens, episode, self.extractLang(file))
 
     def sanitizeDirname(self, path):
         path, ext = os.path.splitext(path)
@@ -303,20 +463,23 @@ class MediaLibrary:
 
         return self.sanitize(path)
 
-    def getExtraData(self, file, nodeInfo, fullpath, properName):
+    def getExtraData(self, file, nodeInfo, fullpath, properName, fileTokens=None):
+        if fileTokens is None:
+            fileTokens = self.tokenizeFilename(file)
+
         extraData = {}
 
         extraData["type"] = "Clip"
 
-        episodeData = self.extractEpisodeNumber(file)
+        episodeData = fileTokens.episode
         if episodeData:
             extraData["episode"] = episodeData
             extraData["type"] = "Show"
-            showName = self.extractShowName(fullpath, properName)
+            showName = self.extractShowName(fullpath, properName, fileTokens)
             if showName:
                 extraData["show"] = showName
 
-        langData = self.extractLang(file)
+        langData = fileTokens.lang
         if langData:
             extraData["lang"] = langData
         MB = 1024*1024
@@ -325,63 +488,311 @@ class MediaLibrary:
         return extraData
 
     def getSubtitles(self, uuid, fullPaths=True):
-        if uuid not in self.media:
-            return {}
+        with self.lock:
+            if uuid not in self.media:
+                return {}
+
+            return self.__subtitleCache.getSubtitles(self.absPathFromUUID[uuid], fullPaths=fullPaths)
+
+    def snapshot(self):
+        """ a copy of media as plain dicts that is safe to serialize while the library is being updated """
+        with self.lock:
+            return {entryUUID: self.media.entry(record) for entryUUID, record in self.media.records()}
+
+    def recentlyModified(self, skip=None):
+        """
+        (version, [(uuid, absolute path, size, mtime)]) of the media, most recently modified first
+        skip: called with (uuid, MediaRecord), entries it returns True for are left out
+        """
+        with self.lock:
+            found = [(entryUUID, self.media.absPath(entryUUID), record.size, record.mtime)
+                     for entryUUID, record in self.media.records() if not (skip and skip(entryUUID, record))]
+            version = self.version
+        found.sort(key=lambda entry: entry[3], reverse=True)
+        return version, found
+
+    def absolutePaths(self):
+        """ set of the absolute paths of all the media """
+        with self.lock:
+            return set(self.media.absPath(entryUUID) for entryUUID in self.media)
+
+    def addMetadata(self, updates):
+        """
+        add metadata that isn't derived from the filename (i.e. probe results) to entries
+        updates: {uuid: {key: value}}, entries that are no longer in the library are skipped
+        """
+        with self.lock:
+            changed = False
+            for entryUUID, metadata in updates.items():
+                if entryUUID not in self.media:
+                    continue
+                for key, value in metadata.items():
+                    self.media.setExtra(entryUUID, key, value)
+                changed = True
+            if changed:
+                self.version += 1
+
+    def entries(self):
+        """
+        returns (version, iterator of (uuid, entry)) for writing the library out
+        the entry dicts are built while iterating, without holding the lock
+        """
+        with self.lock:
+            version = self.version
+            records = list(self.media.records())
+        return version, ((entryUUID, self.media.entry(record)) for entryUUID, record in records)
+
+    def query(self, text=None, mediaType=None, show=None, episode=None, sort='name', descending=False, cursor=None, limit=100):
+        """
+        one page of the library, filtered and sorted (see LibraryIndex.query)
+        raises LibraryIndex.InvalidQuery on bad arguments
+        """
+        with self.lock:
+            uuids, nextCursor, total = self.index.query(text, mediaType, show, episode, sort, descending, cursor, limit)
+            items = []
+            for entryUUID in uuids:
+                entry = self.media[entryUUID]
+                entry['uuid'] = entryUUID
+                items.append(entry)
+            return {'total': total, 'cursor': nextCursor, 'items': items}
+
+    def search(self, text, limit=20):
+        """ the limit entries best matching text (typos are fine), best first, each with its uuid and score """
+        with self.lock:
+            items = []
+            for entryUUID, score in self.index.search(text, limit):
+                entry = self.media[entryUUID]
+                entry['uuid'] = entryUUID
+                entry['score'] = score
+                items.append(entry)
+            return items
+
+    def __episodeEntry(self, entryUUID, season, episode):
+        entry = self.media[entryUUID]
+        entry['uuid'] = entryUUID
+        entry['season_number'] = season
+        entry['episode_number'] = episode
+        return entry
+
+    def shows(self):
+        """ every show with its seasons, number of episodes and the uuid of its first episode """
+        with self.lock:
+            return [{'show': show, 'seasons': seasons, 'episodes': count, 'uuid': firstUUID}
+                    for show, seasons, count, firstUUID in self.showIndex.shows()]
+
+    def showSeasons(self, show, season=None):
+        """ the episodes of show (or only of one of its seasons) in order, None if there is no such show """
+        with self.lock:
+            seasons = self.showIndex.seasons(show, season)
+            if not seasons:
+                return None
+            return {'show': show,
+                    'seasons': [{'season': number,
+                                 'episodes': [self.__episodeEntry(entryUUID, number, episode) for episode, entryUUID in episodes]}
+                                for number, episodes in seasons]}
+
+    def nextEpisode(self, uuid):
+        """ the entry of the episode that comes after uuid, None if there isn't one """
+        with self.lock:
+            nextUUID = self.showIndex.next(uuid)
+            if not nextUUID:
+                return None
+            _, season, episode = self.showIndex.episode(nextUUID)
+            return self.__episodeEntry(nextUUID, season, episode)
+
+    def deriveMedia(self, file, parentDir, fullRelativePath, fileStats):
+        """
+        everything the library knows about a media file that is derived from its name
+        returns (properName, metadata) or None if the file should be skipped
+        """
+        fileTokens = self.tokenizeFilename(file)
+        properName = fileTokens.name
+
+        if not properName:
+            if not file:
+                return None # if the filename is empty skip this
+
+            # probably the file name is only the episode metadata
+            # with blacklisted words, so the parent dir will have
+            # more concrete data (hopefully)
+            properName = self.sanitizeDirname(parentDir)
+            logger.warning(f"Failed to get proper name for {file} using parent dir {parentDir}")
+            if not properName:
+                # fuck it take the filename with all the shit in it
+                properName = file
+                logger.warning(f"Failed to salvage any proper name for file, using filename as-is {file}")
+
+        return properName, self.getExtraData(file, fileStats, fullRelativePath, properName, fileTokens)
+
+    def mediaID(self, fullRelativePath, fileStats):
+        """
+        the id of a media file is derived from the file identity so it stays the same across
+        restarts and rescans (thumbnails and probes cached by id are still good next time)
+        and changes when the file itself changes
+        """
+        identity = f"{fullRelativePath}\0{fileStats.st_size}\0{fileStats.st_mtime_ns}\0{fileStats.st_ino}"
+        entryUUID = str(uuid.uuid5(self.__idNamespace, identity))
+        collision = 0
+        while entryUUID in self.media:
+            # same identity in two media paths, scan order decides who gets which
+            collision += 1
+            entryUUID = str(uuid.uuid5(self.__idNamespace, f"{identity}\0{collision}"))
+        return entryUUID
+
+    def __addMedia(self, mediaPath, root, file, fileStats, derived):
+        filePath = os.path.join(root, file)
+        fullRelativePath = filePath.replace(mediaPath+os.path.sep,"") #remove abs path from what is exposed
+        properName, metadata = derived
+        entryUUID = self.mediaID(fullRelativePath, fileStats)
+        record = self.media.add(entryUUID, mediaPath, root, file, fullRelativePath, fileStats, properName, metadata)
+        self.index.add(entryUUID, record)
+        self.showIndex.add(entryUUID, record)
+
+    def __removeMedia(self, entryUUID):
+        record = self.media.remove(entryUUID)
+        self.index.remove(entryUUID, record)
+        self.showIndex.remove(entryUUID)
+
+    def __addSubtitle(self, mediaPath, root, file):
+        self.__subtitleCache.addSubtitle(os.path.join(root, file), mediaPath)
+
+    def __syncMedia(self, mediaPath, root, file, fileStats):
+        """ add a media file, or update it if it changed since it was added """
+        filePath = os.path.join(root, file)
+        entryUUID = self.media.find(mediaPath, filePath)
+        if entryUUID:
+            record = self.media.record(entryUUID)
+            if record.size == fileStats.st_size and record.mtime == fileStats.st_mtime:
+                return
+            self.__removeMedia(entryUUID)
+
+        parentDir = os.path.basename(os.path.dirname(filePath))
+        fullRelativePath = filePath.replace(mediaPath+os.path.sep,"")
+        derived = self.deriveMedia(file, parentDir, fullRelativePath, fileStats)
+        if derived:
+            self.__addMedia(mediaPath, root, file, fileStats, derived)
+
+    def __syncFile(self, mediaPath, filePath):
+        root, file = os.path.split(filePath)
+        if self.isSubtitleFile(file):
+            self.__subtitleCache.removeSubtitle(filePath)
+            if os.path.isfile(filePath):
+                self.__addSubtitle(mediaPath, root, file)
+            return
 
-        file = self.media[uuid]['actual_name']
-        path = self.media[uuid]['fullpath']
+        if not self.isMediaFile(file):
+            return
 
-        return self.__subtitleCache.getSubtitles(path, file, fullPaths=fullPaths)
+        try:
+            fileStats = os.stat(filePath)
+        except OSError:
+            return self.__removeFile(mediaPath, filePath)
+
+        self.__syncMedia(mediaPath, root, file, fileStats)
+
+    def __removeFile(self, mediaPath, filePath):
+        entryUUID = self.media.find(mediaPath, filePath)
+        if entryUUID:
+            self.__removeMedia(entryUUID)
+        elif self.isSubtitleFile(filePath):
+            self.__subtitleCache.removeSubtitle(filePath)
+
+    def __removeDirectory(self, dirPath):
+        for entryUUID in self.media.findUnder(dirPath):
+            self.__removeMedia(entryUUID)
+        self.__subtitleCache.removeSubtitlesUnder(dirPath)
+
+    def __syncDirectory(self, mediaPath, dirPath):
+        """ bring everything under dirPath up to date with the file system """
+        scanner = LibraryScanner(self.isMediaFile, self.isSubtitleFile, workers=self.scanWorkers, processes=1)
+        listings = scanner.walk([dirPath])
+
+        found = set()
+        self.__subtitleCache.removeSubtitlesUnder(dirPath)
+        for _, listing in listings:
+            for file in listing.subtitles:
+                self.__addSubtitle(mediaPath, listing.root, file)
+
+            for file, fileStats in listing.media:
+                found.add(os.path.join(listing.root, file))
+                self.__syncMedia(mediaPath, listing.root, file, fileStats)
+
+        for entryUUID in self.media.findUnder(dirPath):
+            if self.media.absPath(entryUUID) not in found:
+                self.__removeMedia(entryUUID)
+
+        return [(mediaPath, listing.root) for _, listing in listings]
+
+    def applyChanges(self, changes):
+        """
+        apply a batch of file system changes to the library in one go
+        changes: list of (mediaPath, absolute path, MediaLibrary.Change)
+        returns the (mediaPath, directory) pairs found under added directories
+        """
+        addedDirectories = []
+        with self.lock:
+            for mediaPath, path, change in changes:
+                match change:
+                    case MediaLibrary.Change.FILE_ADDED:
+                        self.__syncFile(mediaPath, path)
+                    case MediaLibrary.Change.FILE_REMOVED:
+                        self.__removeFile(mediaPath, path)
+                    case MediaLibrary.Change.DIR_ADDED:
+                        addedDirectories += self.__syncDirectory(mediaPath, path)
+                    case MediaLibrary.Change.DIR_REMOVED:
+                        self.__removeDirectory(path)
+            self.__dirWordClouds.clear()
+            self.version += 1
+        logger.info(f"Applied {len(changes)} file system changes to the library")
+        return addedDirectories
 
     def scan(self):
         logger.logInfo("Library scan started...")
         start=time.time()
-        for mediaPath in self.mediaPaths:
-            logger.info(f"Scanning media path: {mediaPath}")
-            for root, dirs, files in os.walk(mediaPath):
-                for file in files:
-
-                    isMediaFile = self.isMediaFile(file)
-                    isSubtitleFile = self.isSubtitleFile(file)
-
-                    if not isMediaFile and not isSubtitleFile:
-                        continue
-
-                    filePath = os.path.join(root, file)
-                    parentDir = os.path.basename(os.path.dirname(filePath))
-                    fullRelativePath = filePath.replace(mediaPath+os.path.sep,"") #remove abs path from what is exposed
-
-                    if isSubtitleFile:
-                        self.__subtitleCache.addSubtitle(fullRelativePath, filePath)
-                        continue
-
-                    fileStats = os.stat(filePath)
-
-                    properName = self.sanitizeFilename(file)
-
-                    if not properName:
-                        if not file:
-                            continue # if the filename is empty skip this
-
-                        # probably the file name is only the episode metadata
-                        # with blacklisted words, so the parent dir will have
-                        # more concrete data (hopefully)
-                        properName = self.sanitizeDirname(parentDir)
-                        logger.warning(f"Failed to get proper name for {file} using parent dir {parentDir}")
-                        if not properName:
-                            # fuck it take the filename with all the shit in it
-                            properName = file
-                            logger.warning(f"Failed to salvage any proper name for file, using filename as-is {file}")
-
-                    entryUUID = str(uuid.uuid4())
-                    self.media[entryUUID] = {
-                        'name': properName,
-                        'actual_name': file,
-                        'fullpath': fullRelativePath,
-                        'metadata': self.getExtraData(file, fileStats, fullRelativePath, properName),
-                        'size': fileStats.st_size,
-                        'modified_date': fileStats.st_mtime, #epoch time
-                        'creation_date': fileStats.st_ctime  #epoch time
-                    }
-                    self.absPathFromUUID[entryUUID] = filePath
-        logger.logInfo("Library scan done. {} seconds".format(time.time()-start))
\ No newline at end of file
+
+        manifest = None
+        if self.manifestPath:
+            fingerprint = ScanManifest.makeFingerprint(self.allowedExt,
+                                                       self.allowedSubtitleExt,
+                                                       self.blacklist,
+                                                       self.compoundBlacklist,
+                                                       self.patches.config if self.patches else None)
+            manifest = ScanManifest(self.manifestPath, fingerprint)
+            manifest.load()
+
+        scanner = LibraryScanner(self.isMediaFile, self.isSubtitleFile, workers=self.scanWorkers, processes=self.scanProcesses, manifest=manifest)
+        listings = scanner.walk(self.mediaPaths)
+
+        jobs = []
+        for mediaPath, listing in listings:
+            for file in listing.subtitles:
+                self.__addSubtitle(mediaPath, listing.root, file)
+
+            if listing.derived is not None:
+                continue # restored from the manifest
+
+            for file, fileStats in listing.media:
+                filePath = os.path.join(listing.root, file)
+                parentDir = os.path.basename(os.path.dirname(filePath))
+                fullRelativePath = filePath.replace(mediaPath+os.path.sep,"") #remove abs path from what is exposed
+                jobs.append((file, parentDir, fullRelativePath, fileStats))
+
+        derivedResults = iter(scanner.derive(self, jobs))
+
+        with self.lock:
+            for mediaPath, listing in listings:
+                if listing.derived is None:
+                    listing.derived = [next(derivedResults) for _ in listing.media]
+
+                for (file, fileStats), derived in zip(listing.media, listing.derived):
+                    if derived:
+                        self.__addMedia(mediaPath, listing.root, file, fileStats, derived)
+
+            self.scannedDirectories = [(mediaPath, listing.root) for mediaPath, listing in listings]
+            self.__dirWordClouds.clear()
+            self.version += 1
+
+        if manifest:
+            manifest.save(listings)
+
+        logger.logInfo("Library scan done. {} seconds".format(time.time()-start))
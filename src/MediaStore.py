@@ -0,0 +1,242 @@
+import os
+import sys
+from enum import Enum
+from collections.abc import Mapping
+
+"""
+compact storage for the library entries
+a library with a lot of files used to keep a dict per entry (plus a metadata dict and the absolute path
+a second time in absPathFromUUID), here every entry is a slotted record, directories are stored once in a
+path table and shared by all the files in them, and the repeating strings (show names, episode numbers,
+languages) are interned
+the store is a read only Mapping of uuid -> entry dict, so it can be used exactly like the old media dict,
+the entry dicts are built every time they are asked for. code that only needs a few fields of an entry
+reads them from its record (record(uuid)) instead
+"""
+
+class MediaType(Enum):
+    CLIP='Clip'
+    SHOW='Show'
+    MOVIE='Movie'
+
+
+class MediaRecord:
+    __slots__ = ('name', 'file', 'dir', 'type', 'show', 'episode', 'lang', 'size', 'mtime', 'ctime', 'extra')
+
+    def __init__(self, name, file, dir, type, show, episode, lang, size, mtime, ctime, extra) -> None:
+        self.name = name
+        self.file = file        # actual name of the file
+        self.dir = dir          # index in the path table
+        self.type = type        # MediaType
+        self.show = show
+        self.episode = episode
+        self.lang = lang
+        self.size = size
+        self.mtime = mtime
+        self.ctime = ctime
+        self.extra = extra      # any other metadata keys, None if there are none
+
+
+class PathTable:
+    """
+    every directory that has media in it, stored once
+    a directory is dropped when the last file that was added in it is released
+    """
+
+    def __init__(self) -> None:
+        self.__dirs = {}   # index -> (absolute directory, relative path prefix, media path)
+        self.__files = {}  # index -> number of files added in the directory
+        self.__index = {}  # (absolute directory, media path) -> index
+        self.__nextIndex = 0 # indexes aren't reused, records keep theirs
+
+    @staticmethod
+    def normalize(root):
+        # the scan joins paths under the media path itself, the watcher splits them
+        return root.rstrip(os.sep) or os.sep
+
+    def add(self, mediaPath, root, relativePrefix):
+        """ index of the directory for a file added in it, to be released when the file is removed """
+        root = self.normalize(root)
+        key = (root, mediaPath)
+        index = self.__index.get(key)
+        if index is None:
+            index = self.__nextIndex
+            self.__nextIndex += 1
+            self.__dirs[index] = (root, relativePrefix, mediaPath)
+            self.__files[index] = 0
+            self.__index[key] = index
+        self.__files[index] += 1
+        return index
+
+    def release(self, index):
+        """ a file added in the directory was removed """
+        self.__files[index] -= 1
+        if self.__files[index] > 0:
+            return
+        root, _, mediaPath = self.__dirs.pop(index)
+        del self.__files[index]
+        del self.__index[(root, mediaPath)]
+
+    def find(self, mediaPath, root):
+        return self.__index.get((self.normalize(root), mediaPath))
+
+    def get(self, index):
+        """ (absolute directory, relative path prefix) """
+        root, relativePrefix, _ = self.__dirs[index]
+        return root, relativePrefix
+
+    def indexesUnder(self, directory):
+        """ indexes of directory and every directory under it """
+        directory = self.normalize(directory)
+        prefix = directory.rstrip(os.sep) + os.sep
+        return [index for index, (root, _, _) in self.__dirs.items() if root == directory or root.startswith(prefix)]
+
+    def __len__(self):
+        return len(self.__dirs)
+
+
+class AbsolutePathView(Mapping):
+    """ uuid -> absolute path of the media file, read only view of a MediaStore """
+
+    def __init__(self, store) -> None:
+        self.__store = store
+
+    def __getitem__(self, uuid):
+        return self.__store.absPath(uuid)
+
+    def __iter__(self):
+        return iter(self.__store)
+
+    def __len__(self):
+        return len(self.__store)
+
+    def __contains__(self, uuid):
+        return uuid in self.__store
+
+
+class MediaStore(Mapping):
+    __metadataKeys = ('type', 'episode', 'show', 'lang')
+
+    def __init__(self) -> None:
+        self.__records = {}  # uuid -> MediaRecord
+        self.__byDir = {}    # path table index -> {file: uuid}
+        self.paths = PathTable()
+        self.absPaths = AbsolutePathView(self)
+
+    ########################################################################
+    # changing the store
+    ########################################################################
+
+    def add(self, uuid, mediaPath, root, file, fullRelativePath, fileStats, properName, metadata):
+        relativePrefix = fullRelativePath[:len(fullRelativePath)-len(file)]
+        dirIndex = self.paths.add(mediaPath, root, relativePrefix)
+
+        extra = {key: value for key, value in metadata.items() if key not in self.__metadataKeys}
+        record = MediaRecord(properName,
+                             file,
+                             dirIndex,
+                             MediaType(metadata.get('type', MediaType.CLIP.value)),
+                             self.__intern(metadata.get('show')),
+                             self.__intern(metadata.get('episode')),
+                             self.__intern(metadata.get('lang')),
+                             fileStats.st_size,
+                             fileStats.st_mtime,
+                             fileStats.st_ctime,
+                             extra or None)
+        self.__records[uuid] = record
+        self.__byDir.setdefault(dirIndex, {})[file] = uuid
+        return record
+
+    def remove(self, uuid):
+        record = self.__records.pop(uuid)
+        files = self.__byDir.get(record.dir)
+        if files and files.get(record.file) == uuid:
+            del files[record.file]
+            if not files:
+                del self.__byDir[record.dir]
+        self.paths.release(record.dir)
+        return record
+
+    def setExtra(self, uuid, key, value):
+        """ add a metadata key that isn't derived from the filename (i.e. probe results) """
+        record = self.__records[uuid]
+        if record.extra is None:
+            record.extra = {}
+        record.extra[key] = value
+
+    @staticmethod
+    def __intern(value):
+        if isinstance(value, str):
+            return sys.intern(value)
+        return value
+
+    ########################################################################
+    # lookups
+    ########################################################################
+
+    def record(self, uuid):
+        return self.__records.get(uuid)
+
+    def records(self):
+        return self.__records.items()
+
+    def absPath(self, uuid):
+        record = self.__records[uuid]
+        root, _ = self.paths.get(record.dir)
+        return os.path.join(root, record.file)
+
+    def find(self, mediaPath, filePath):
+        """ uuid of the media at filePath or None """
+        root, file = os.path.split(filePath)
+        dirIndex = self.paths.find(mediaPath, root)
+        if dirIndex is None:
+            return None
+        return self.__byDir.get(dirIndex, {}).get(file)
+
+    def findUnder(self, directory):
+        """ uuids of all the media under directory """
+        found = []
+        for dirIndex in self.paths.indexesUnder(directory):
+            found += self.__byDir.get(dirIndex, {}).values()
+        return found
+
+    def metadata(self, record):
+        metadata = {'type': record.type.value}
+        if record.episode is not None:
+            metadata['episode'] = record.episode
+        if record.show is not None:
+            metadata['show'] = record.show
+        if record.lang is not None:
+            metadata['lang'] = record.lang
+        if record.extra:
+            metadata.update(record.extra)
+        return metadata
+
+    def entry(self, record):
+        """ the record as the dict the front end knows """
+        _, relativePrefix = self.paths.get(record.dir)
+        return {
+            'name': record.name,
+            'actual_name': record.file,
+            'fullpath': relativePrefix + record.file,
+            'metadata': self.metadata(record),
+            'size': record.size,
+            'modified_date': record.mtime, #epoch time
+            'creation_date': record.ctime  #epoch time
+        }
+
+    ########################################################################
+    # Mapping
+    ########################################################################
+
+    def __getitem__(self, uuid):
+        return self.entry(self.__records[uuid])
+
+    def __iter__(self):
+        return iter(self.__records)
+
+    def __len__(self):
+        return len(self.__records)
+
+    def __contains__(self, uuid):
+        return uuid in self.__records
@@ -6,10 +6,10 @@ class Patches:
     __namesKey = "names"
     __thumbnailsKey = "thumbnails"
 
-    def __init__(self) -> None:
+    def __init__(self, filename="patches/patches.json") -> None:
         self.logging = Shnoolog("Patches")
         self.timestampPattern = re.compile('^[0-9]{2}:[0-9]{2}:[0-9]{2}$')
-        self.filename = "patches/patches.json"
+        self.filename = filename
         with open(self.filename, "r") as jsonFile:
             self.config = json.load(jsonFile)
 
@@ -0,0 +1,120 @@
+import os
+import json
+import threading
+from Shnoolog import Shnoolog
+
+"""
+ffprobe results of media files, keyed by the file's path, size and mtime so a result stays valid
+across runs (and a file that was replaced is probed again)
+only the format/stream fields the UI and the transcoder use are kept and every result is held as a
+compact json string, a small fraction of the memory the parsed ffprobe output takes
+optionally persisted to a json file (in cache_path), so files that were probed once are not probed
+again after a restart
+"""
+
+class ProbeStore:
+    version = 1
+    formatFields = ('format_name', 'format_long_name', 'duration', 'size', 'bit_rate', 'nb_streams')
+    streamFields = ('index', 'codec_type', 'codec_name', 'codec_long_name', 'profile',
+                    'width', 'height', 'pix_fmt', 'color_space', 'color_transfer', 'color_primaries',
+                    'r_frame_rate', 'avg_frame_rate', 'sample_rate', 'channels', 'channel_layout',
+                    'bit_rate', 'duration')
+    tagFields = ('language', 'title', 'handler_name', 'creation_time')
+    dispositionFields = ('default', 'forced', 'attached_pic')
+
+    def __init__(self, path=None) -> None:
+        self.logger = Shnoolog("ProbeStore")
+        self.path = path
+        self.__probes = {} # path -> (size, mtime, compact json)
+        self.__lock = threading.Lock()
+        self.__changed = False
+
+    @classmethod
+    def compact(cls, data):
+        """ the fields of an ffprobe -show_format -show_streams result we use """
+        def pick(obj, fields):
+            return {field: obj[field] for field in fields if field in obj}
+
+        fileFormat = data.get('format', {})
+        compacted = {'format': pick(fileFormat, cls.formatFields), 'streams': []}
+        if 'tags' in fileFormat:
+            compacted['format']['tags'] = pick(fileFormat['tags'], cls.tagFields)
+
+        for stream in data.get('streams', []):
+            compactStream = pick(stream, cls.streamFields)
+            compactStream['tags'] = pick(stream.get('tags', {}), cls.tagFields)
+            if 'disposition' in stream:
+                compactStream['disposition'] = pick(stream['disposition'], cls.dispositionFields)
+            compacted['streams'].append(compactStream)
+        return compacted
+
+    def get(self, path, size, mtime):
+        """ the stored (compact) probe of the file, None if it wasn't probed or it changed since """
+        found = self.__probes.get(path)
+        if not found or found[0] != size or found[1] != mtime:
+            return None
+        return json.loads(found[2])
+
+    def contains(self, path, size, mtime):
+        found = self.__probes.get(path)
+        return found is not None and found[0] == size and found[1] == mtime
+
+    def put(self, path, size, mtime, data):
+        """ stores a raw ffprobe result, returns its compact form """
+        compacted = self.compact(data)
+        with self.__lock:
+            self.__probes[path] = (size, mtime, json.dumps(compacted, separators=(',', ':')))
+            self.__changed = True
+        return compacted
+
+    def __len__(self):
+        return len(self.__probes)
+
+    ########################################################################
+    # persistence
+    ########################################################################
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "r") as jsonFile:
+                stored = json.load(jsonFile)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Failed to read probe store {self.path}, starting with an empty one. {e}")
+            return
+
+        if stored.get('version') != self.version:
+            self.logger.info("Probe store is from a different version, starting with an empty one")
+            return
+
+        with self.__lock:
+            for path, (size, mtime, probe) in stored.get('probes', {}).items():
+                self.__probes.setdefault(path, (size, mtime, probe))
+        self.logger.info(f"Loaded {len(self.__probes)} probes from {self.path}")
+
+    def save(self, keep=None):
+        """
+        keep: paths to keep (i.e. the files in the library), the probes of other files are dropped
+        """
+        if not self.path:
+            return
+
+        with self.__lock:
+            if keep is not None:
+                for path in [path for path in self.__probes if path not in keep]:
+                    del self.__probes[path]
+                    self.__changed = True
+            if not self.__changed:
+                return
+            stored = {'version': self.version, 'probes': dict(self.__probes)}
+            self.__changed = False
+
+        tmpPath = self.path + ".tmp"
+        try:
+            with open(tmpPath, "w") as jsonFile:
+                json.dump(stored, jsonFile, separators=(',', ':'))
+            os.replace(tmpPath, self.path)
+        except OSError as e:
+            self.logger.error(f"Failed to write probe store {self.path}: {e}")
@@ -0,0 +1,131 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from MediaLibrary import MediaLibrary
+from FFMpeg import FFMpeg
+from Shnoolog import Shnoolog
+
+"""
+probes the library with ffprobe in the background so opening a title doesn't wait for it
+the most recently modified files go first, at most workers ffprobe processes run at a time (at the lowest
+cpu priority) and none are started while a video is being transcoded. the probe output is kept in the
+FFMpeg probe store like any other probe (saved after every pass when it's persisted) and a summary of it
+(duration, resolution, codecs) is added to the library entries in batches, so the library version doesn't
+change for every file. files that are already in the probe store only get their summary added
+media that is added to the library later is picked up once the library version changes
+"""
+
+class ProbeWarmer:
+    idleSeconds = 5           # how often to look for new media once everything is probed
+    transcodePauseSeconds = 2 # how often to check if a transcode is done
+    batchSize = 100           # summaries to collect before adding them to the library
+    batchSeconds = 10         # or seconds since the last batch was added
+    summaryKeys = frozenset(('duration', 'resolution', 'video_codec', 'audio_codec'))
+
+    def __init__(self, library: MediaLibrary, ffmpeg: FFMpeg, workers=1) -> None:
+        self.logger = Shnoolog("ProbeWarmer")
+        self.library = library
+        self.ffmpeg = ffmpeg
+        self.workers = max(1, workers)
+        self.__failed = set() # uuids ffprobe failed on, not tried again
+        self.__pending = {}   # uuid -> summary not added to the library yet
+        self.__lastBatch = time.monotonic()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name="ProbeWarmer", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def __skip(self, uuid, record):
+        """ failed before or already has a summary """
+        return uuid in self.__failed or (record.extra is not None and not self.summaryKeys.isdisjoint(record.extra))
+
+    def __probe(self, uuid, path, size, mtime):
+        data = self.ffmpeg.probe(path, size, mtime, lowPriority=True)
+        if not data:
+            return uuid, None
+        return uuid, FFMpeg.probeSummary(data)
+
+    def __collect(self, done):
+        """ returns False if ffprobe can't be run at all """
+        for future in done:
+            try:
+                uuid, summary = future.result()
+            except OSError as e:
+                self.logger.logError(f"Failed to run ffprobe, stopping the background probing. {e}")
+                return False
+            except Exception as e:
+                self.logger.error(f"Background probe failed: {e}")
+                continue
+            if not summary:
+                self.__failed.add(uuid)
+            else:
+                self.__pending[uuid] = summary
+        return True
+
+    def __addPending(self, force=False):
+        if not self.__pending:
+            return
+        if not force and len(self.__pending) < self.batchSize and time.monotonic() - self.__lastBatch < self.batchSeconds:
+            return
+        self.library.addMetadata(self.__pending)
+        self.__pending = {}
+        self.__lastBatch = time.monotonic()
+
+    def __waitForTranscode(self):
+        while self.ffmpeg.isTranscoding() and not self.__stop.is_set():
+            self.__stop.wait(self.transcodePauseSeconds)
+
+    def __probeAll(self, pool, candidates):
+        """ returns False if ffprobe can't be run at all """
+        running = set()
+        for candidate in candidates:
+            if self.__stop.is_set():
+                break
+            if self.ffmpeg.isTranscoding():
+                # let the running probes finish, don't start new ones until the transcode is done
+                if not self.__collect(wait(running)[0]):
+                    return False
+                running = set()
+                self.__addPending(force=True)
+                self.__waitForTranscode()
+                if self.__stop.is_set():
+                    break
+            if len(running) >= self.workers:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                if not self.__collect(done):
+                    return False
+                self.__addPending()
+            running.add(pool.submit(self.__probe, *candidate))
+
+        ok = self.__collect(wait(running)[0])
+        self.__addPending(force=True)
+        return ok
+
+    def __run(self):
+        lastVersion = None
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ProbeWarmer") as pool:
+            while not self.__stop.is_set():
+                if self.library.version == lastVersion:
+                    self.__stop.wait(self.idleSeconds)
+                    continue
+
+                lastVersion, candidates = self.library.recentlyModified(skip=self.__skip)
+                if not candidates:
+                    continue
+
+                self.logger.logInfo(f"Probing {len(candidates)} media files in the background")
+                start = time.monotonic()
+                finished = self.__probeAll(pool, candidates)
+                self.ffmpeg.probes.save()
+                if not finished:
+                    return
+                if not self.__stop.is_set():
+                    self.logger.logInfo(f"Background probing done in {time.monotonic() - start:.1f} seconds")
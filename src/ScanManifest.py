@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import hashlib
+from Shnoolog import Shnoolog
+
+"""
+opt-in record of the last library scan
+for every scanned directory we keep its mtime, its sub directories and the
+records derived from its files, a directory whose mtime didn't change since the
+last scan didn't have anything added/removed/renamed in it, so the next scan can
+take its content from here without listing or stat-ing any of its files
+note: a file that was changed in place (same name) keeps its old size/dates
+until something else in its directory changes
+"""
+class ScanManifest:
+    version = 1
+    # directories modified this close to the scan are not trusted, they may still be changing
+    # (and a change in the same mtime tick wouldn't be noticed)
+    racyWindowSeconds = 2
+
+    def __init__(self, path, fingerprint) -> None:
+        self.logger = Shnoolog("ScanManifest")
+        self.path = path
+        self.fingerprint = fingerprint
+        self.__paths = {}
+        self.__scanStart = time.time()
+
+    @staticmethod
+    def makeFingerprint(*settings):
+        """ anything that changes how records are derived must be part of the fingerprint """
+        data = json.dumps([ScanManifest.version, settings], sort_keys=True, default=str)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def load(self):
+        self.__scanStart = time.time()
+        self.__paths = {}
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "r") as jsonFile:
+                manifest = json.load(jsonFile)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Failed to read scan manifest {self.path}, doing a full scan. {e}")
+            return
+
+        if manifest.get('fingerprint') != self.fingerprint:
+            self.logger.info("Scan manifest is from different settings, doing a full scan")
+            return
+
+        self.__paths = manifest.get('paths', {})
+
+    def lookup(self, mediaPath, root, mtime):
+        """ returns the stored directory entry if it's still up to date """
+        entry = self.__paths.get(mediaPath, {}).get(root)
+        if entry and entry['mtime'] == mtime:
+            return entry
+        return None
+
+    def save(self, listings):
+        """
+        listings: (mediaPath, ScannedDir) pairs of the scan that just finished
+        """
+        racyMtime = (self.__scanStart - self.racyWindowSeconds) * 1e9
+        paths = {}
+        for mediaPath, listing in listings:
+            if listing.mtime is None or listing.mtime >= racyMtime:
+                continue
+
+            media = []
+            for (file, fileStats), derived in zip(listing.media, listing.derived):
+                media.append([file,
+                              fileStats.st_size,
+                              fileStats.st_mtime,
+                              fileStats.st_ctime,
+                              fileStats.st_ino,
+                              fileStats.st_mtime_ns,
+                              derived])
+
+            paths.setdefault(mediaPath, {})[listing.root] = {
+                'mtime': listing.mtime,
+                'dirs': listing.dirs,
+                'subtitles': listing.subtitles,
+                'media': media
+            }
+
+        manifest = {'fingerprint': self.fingerprint, 'paths': paths}
+        tmpPath = self.path + ".tmp"
+        try:
+            with open(tmpPath, "w") as jsonFile:
+                json.dump(manifest, jsonFile, separators=(',', ':'))
+            os.replace(tmpPath, self.path)
+        except OSError as e:
+            self.logger.error(f"Failed to write scan manifest {self.path}: {e}")
@@ -1,7 +1,14 @@
 from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 import os
 import json
+import zlib
+import select
+import socket
 from MediaLibrary import MediaLibrary
+from LibraryIndex import LibraryIndex
+from LibraryPayload import LibraryPayloadCache
+from JsonStream import ChunkedJsonWriter
+from JobScheduler import JobScheduler
 import mimetypes
 import FFMpeg
 import shutil
@@ -38,6 +45,7 @@ class ShnoodleServerContext():
         self.cache = cache
         self.config = config
         self.library = library
+        self.listPayload = LibraryPayloadCache(library)
         self.telemetry = telemetry
         self.gpuWrapper = gpuWrapper
 
@@ -97,6 +105,12 @@ class ShnoodleServerHandler(BaseHTTPRequestHandler):
     protocol_version = "HTTP/1.1"
     server_version = "Nanya Business/HTTP1.1"
     sys_version = "Clouds & Whispers/1.3.2-patch.1.1"
+    defaultQueryLimit = 100
+    maxQueryLimit = 1000
+    defaultSearchLimit = 20
+    maxSearchLimit = 200
+    thumbRenditions = [160, 320, 640]
+    thumbFormats = ['webp', 'jpeg'] # in order of preference, the last one is used when the client accepts none
 
     # overwrite request log with nothing to prevent from console prints
     def log_request(self, code='-', size='-'):
@@ -120,6 +134,9 @@ class ShnoodleServerHandler(BaseHTTPRequestHandler):
     def conf(self):
         return ShnoodleServerHandler.__context.config
 
+    def listPayload(self):
+        return ShnoodleServerHandler.__context.listPayload
+
     def cache(self):
         return ShnoodleServerHandler.__context.cache
 
@@ -161,10 +178,30 @@ class ShnoodleServerHandler(BaseHTTPRequestHandler):
 
         self.serveHTML(content, length=size, status=HTTPStatus.NOT_FOUND)
 
+    def clientDisconnected(self):
+        """
+        if the client closed the connection (i.e. the browser cancelled the request), checked without
+        reading anything: the socket is readable and peeking returns nothing
+        """
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            if not readable:
+                return False
+            return self.connection.recv(1, socket.MSG_PEEK) == b''
+        except (OSError, ValueError):
+            return True
+
+    def serveBusy(self, retryAfterSeconds=1):
+        self.send_response(HTTPStatus.SERVICE_UNAVAILABLE)
+        self.send_header("Retry-After", retryAfterSeconds)
+        self.send_header("Content-Length", 0)
+        self.end_headers()
+
     def serveThumbnail(self, thumb):
         self.send_response(200)
         self.send_header('Content-type', thumb['mime'])
         self.send_header("Content-Length", thumb['size'])
+        self.send_header("Vary", "Accept")
         self.send_header("Cache-Control", "public, max-age=604800, immutable")
         self.send_header("Connection", "close")
         self.end_headers()
@@ -224,6 +261,36 @@ class ShnoodleServerHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.protectedWrite(data)
 
+    def serveJsonStream(self, produce, encoding='identity'):
+        """
+        stream json to the client as it is serialized
+        produce: called with a ChunkedJsonWriter to write the json with
+        encoding: identity or gzip
+        returns True if the whole response was sent
+        """
+        chunked = self.request_version != "HTTP/1.0"
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/json')
+        if encoding != 'identity':
+            self.send_header("Content-Encoding", encoding)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Connection", "close") # the end of the body is the end of the connection
+            self.close_connection = True
+        self.end_headers()
+
+        compressor = zlib.compressobj(wbits=31) if encoding == 'gzip' else None
+        writer = ChunkedJsonWriter(self.wfile.write, chunked=chunked, compressor=compressor)
+        try:
+            produce(writer)
+            writer.close()
+        except Exception as e:
+            logger.warning(f"socket closed before end of content {e}")
+            self.close_connection = True # the chunked body was cut off, the connection can't be reused
+            return False
+        return True
+
     def serveText(self, data):
         self.send_response(HTTPStatus.OK)
         self.send_header('Content-Type', 'text/plain')
@@ -280,19 +347,76 @@ class ShnoodleServerHandler(BaseHTTPRequestHandler):
             logger.error(f"Failed to find the file: {mediaPath} to generate thumbnail from")
             return self.serve404()
 
+        mediaRecord = self.library().media.record(mediaUUID)
+        if not mediaRecord:
+            return self.serve404() # removed from the library meanwhile
+
         timeCodeType = self.getQueryParam(self.path, "type")
         if not timeCodeType:
             return self.serve404()
 
-        thumb = self.ffmpeg().generateThumbnail(mediaPath,
-                                                mediaUUID,
-                                                self.library().media[mediaUUID],
-                                                int(timeCodeType),
-                                                self.conf().get('thumbWidth'),
-                                                self.conf().get('thumbQuality'))
+        width = self.conf().get('thumbWidth')
+        requestedWidth = self.getQueryParam(self.path, "width", optional=True)
+        if requestedWidth:
+            try:
+                width = self.snapThumbnailWidth(int(requestedWidth))
+            except ValueError:
+                return self.serveErrorAsJSON(f"invalid width {requestedWidth}")
+
+        try:
+            thumb = self.ffmpeg().generateThumbnail(mediaPath,
+                                                    mediaUUID,
+                                                    mediaRecord,
+                                                    int(timeCodeType),
+                                                    width,
+                                                    self.conf().get('thumbQuality'),
+                                                    self.negotiateImageFormat(self.headers.get('Accept')),
+                                                    abandoned=self.clientDisconnected)
+        except JobScheduler.QueueFull as e:
+            logger.warning(f"Too many thumbnails requested, {e}")
+            return self.serveBusy()
+
+        if thumb is None:
+            logger.info(f"Client is gone, dropped thumbnail request {self.path}")
+            self.close_connection = True
+            return
 
         return self.serveThumbnail(thumb)
 
+    def snapThumbnailWidth(self, width):
+        """ the smallest of the thumbRenditions widths that is at least width (the largest one if none is) """
+        renditions = sorted(self.conf().get('thumbRenditions') or ShnoodleServerHandler.thumbRenditions)
+        for rendition in renditions:
+            if rendition >= width:
+                return rendition
+        return renditions[-1]
+
+    def negotiateImageFormat(self, accept):
+        """
+        the first of thumbFormats the client lists in Accept (with q > 0), avif/webp have to be listed
+        explicitly (every browser sends */*), the last format is used if none are
+        """
+        formats = [imageFormat for imageFormat in self.conf().get('thumbFormats', []) if imageFormat in FFMpeg.FFMpeg.thumbFormats]
+        formats = formats or ShnoodleServerHandler.thumbFormats
+        accepted = set()
+        for mediaRange in (accept or "").split(","):
+            mediaType, _, params = mediaRange.strip().partition(";")
+            quality = 1.0
+            for param in params.split(";"):
+                name, _, value = param.strip().partition("=")
+                if name == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0
+            if quality > 0:
+                accepted.add(mediaType.strip().lower())
+
+        for imageFormat in formats:
+            if FFMpeg.FFMpeg.thumbFormats[imageFormat][0] in accepted:
+                return imageFormat
+        return formats[-1]
+
     def processProbeRequest(self, url):
         mediaUUID = self.getValidUUIDParam(url, "UUID")
         if not mediaUUID:
@@ -303,14 +427,123 @@ class ShnoodleServerHandler(BaseHTTPRequestHandler):
             logger.error(f"Failed to find the file: {mediaPath} to probe")
             return self.serve404()
 
-        metadata = self.ffmpeg().probe(mediaPath, mediaUUID)
+        try:
+            metadata = self.ffmpeg().probe(mediaPath, abandoned=self.clientDisconnected)
+        except JobScheduler.QueueFull as e:
+            logger.warning(f"Too many probes requested, {e}")
+            return self.serveBusy()
+
+        if self.clientDisconnected():
+            logger.info(f"Client is gone, dropped probe request {self.path}")
+            self.close_connection = True
+            return
 
         if not metadata:
             return self.serve404()
 
         metadata['subtitles'] = self.library().getSubtitles(mediaUUID, fullPaths=False)
 
-        return self.serveObjectAsJsonData(metadata)
+        return self.serveJsonStream(lambda writer: writer.writeObject(metadata))
+
+    def processListRequest(self):
+        payload = self.listPayload().get()
+        encoding = self.listPayload().negotiate(self.headers.get('Accept-Encoding'), codings=self.listPayload().codings(payload))
+        etag = payload.etag(encoding)
+
+        if self.listPayload().matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            return
+
+        data = self.listPayload().body(payload, encoding)
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/json')
+        if encoding != 'identity':
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", len(data))
+        self.send_header("ETag", etag)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Cache-Control", "no-cache") # always revalidate, the library may have changed
+        self.end_headers()
+        self.protectedWrite(data)
+
+    def processQueryRequest(self, url):
+        """
+        /query?q=words&type=Show&show=name&episode=S01&sort=name|size|date&order=asc|desc&cursor=c&limit=n
+        all params are optional, the response cursor is passed back to get the next page
+        """
+        urlParams = parse.parse_qs(parse.urlparse(url).query)
+        def param(key, default=None):
+            return urlParams[key][0] if key in urlParams else default
+
+        try:
+            limit = min(int(param('limit', self.defaultQueryLimit)), self.maxQueryLimit)
+        except ValueError:
+            return self.serveErrorAsJSON(f"invalid limit {param('limit')}")
+
+        order = param('order', 'asc')
+        if order not in ('asc', 'desc'):
+            return self.serveErrorAsJSON(f"invalid order {order}")
+
+        try:
+            page = self.library().query(text=param('q'),
+                                        mediaType=param('type'),
+                                        show=param('show'),
+                                        episode=param('episode'),
+                                        sort=param('sort', 'name'),
+                                        descending=order == 'desc',
+                                        cursor=param('cursor'),
+                                        limit=limit)
+        except LibraryIndex.InvalidQuery as e:
+            return self.serveErrorAsJSON(str(e))
+
+        return self.serveObjectAsJsonData(page)
+
+    def processSearchRequest(self, url):
+        """
+        /search?q=words&limit=n ranked fuzzy search
+        """
+        text = self.getQueryParam(url, "q", optional=True)
+        if not text:
+            return self.serveObjectAsJsonData([])
+
+        limit = self.getQueryParam(url, "limit", optional=True)
+        try:
+            limit = min(int(limit), self.maxSearchLimit) if limit else self.defaultSearchLimit
+            return self.serveObjectAsJsonData(self.library().search(text, limit))
+        except (ValueError, LibraryIndex.InvalidQuery):
+            return self.serveErrorAsJSON(f"invalid limit {limit}")
+
+    def processShowRequest(self, url):
+        """
+        /show?name=show[&season=n] the seasons of a show with their episodes in order
+        """
+        show = self.getQueryParam(url, "name")
+        if not show:
+            return self.serve404()
+
+        season = self.getQueryParam(url, "season", optional=True)
+        try:
+            season = int(season) if season else None
+        except ValueError:
+            return self.serveErrorAsJSON(f"invalid season {season}")
+
+        seasons = self.library().showSeasons(show, season)
+        if not seasons:
+            return self.serve404()
+
+        return self.serveObjectAsJsonData(seasons)
+
+    def processNextEpisodeRequest(self, url):
+        mediaUUID = self.getValidUUIDParam(url, "UUID")
+        if not mediaUUID:
+            return self.serve404()
+
+        # null when it's the last episode
+        return self.serveObjectAsJsonData(self.library().nextEpisode(mediaUUID))
 
     def processStreamRequest(self, url):
         mediaUUID = self.getValidUUIDParam(url, "UUID")
@@ -378,7 +611,39 @@ class ShnoodleServerHandler(BaseHTTPRequestHandler):
         relativePath = streamPath.removeprefix(self.conf().get('resource_path')+os.path.sep)
         streamPath = os.path.join(self.streamProxyPath(), relativePath)
 
-        return self.serveObjectAsJsonData({"stream":"/"+streamPath})
+        response = {"stream":"/"+streamPath}
+        if self.conf().get('trickplay', True) and mediaUUID not in self.ffmpeg().trickplayFailed:
+            self.ffmpeg().startTrickplay(mediaPath, mediaUUID)
+            response['trickplay'] = self.trickplayURL(mediaUUID)
+        return self.serveObjectAsJsonData(response)
+
+    def trickplayURL(self, mediaUUID):
+        relativePath = self.ffmpeg().trickplayPath(mediaUUID).removeprefix(self.conf().get('resource_path')+os.path.sep)
+        return "/" + os.path.join(self.streamProxyPath(), relativePath)
+
+    def processTrickplayRequest(self, url):
+        """
+        {"trickplay": url of the WebVTT thumbnail track, "ready": false while its sprite sheets are being made}
+        starts making them if they weren't yet
+        """
+        mediaUUID = self.getValidUUIDParam(url, "UUID")
+        if not mediaUUID:
+            return self.serve404()
+
+        if not self.conf().get('trickplay', True):
+            return self.serveErrorAsJSON("trickplay is turned off")
+
+        mediaPath = self.library().absPathFromUUID[mediaUUID]
+        if not os.path.exists(mediaPath):
+            logger.error(f"Failed to find the file: {mediaPath} to generate trickplay from")
+            return self.serve404()
+
+        if mediaUUID in self.ffmpeg().trickplayFailed:
+            return self.serveErrorAsJSON("failed to generate trickplay")
+
+        self.ffmpeg().startTrickplay(mediaPath, mediaUUID)
+        ready = os.path.exists(self.ffmpeg().trickplayPath(mediaUUID))
+        return self.serveObjectAsJsonData({"trickplay": self.trickplayURL(mediaUUID), "ready": ready})
 
     def processDownloadRequest(self, url):
         mediaUUID = self.getValidUUIDParam(url, "UUID")
@@ -390,13 +655,15 @@ class ShnoodleServerHandler(BaseHTTPRequestHandler):
             logger.error(f"Failed to find the file: {mediaPath} to download")
             return self.serve404()
 
-        mediaInfo = self.library().media[mediaUUID]
+        mediaRecord = self.library().media.record(mediaUUID)
+        if not mediaRecord:
+            return self.serve404() # removed from the library meanwhile
 
         with open(mediaPath, 'rb') as file:
             self.send_response(HTTPStatus.OK)
             self.send_header("Content-Type", 'application/octet-stream')
             self.send_header("Content-Disposition", 'attachment; filename="{}"'.format(os.path.basename(mediaPath)))
-            self.send_header("Content-Length", str(mediaInfo['size']) )
+            self.send_header("Content-Length", str(mediaRecord.size) )
             self.end_headers()
             shutil.copyfileobj(file, self.wfile)
 
@@ -422,8 +689,22 @@ class ShnoodleServerHandler(BaseHTTPRequestHandler):
     def do_GET(self):
 
         if self.path == '/list':
-            self.serveObjectAsJsonData(self.library().media)
-            return
+            return self.processListRequest()
+
+        if self.path == '/query' or self.path.startswith('/query?'):
+            return self.processQueryRequest(self.path)
+
+        if self.path.startswith('/search?'):
+            return self.processSearchRequest(self.path)
+
+        if self.path == '/shows':
+            return self.serveJsonStream(lambda writer: writer.writeSequence(self.library().shows()))
+
+        if self.path.startswith('/show?'):
+            return self.processShowRequest(self.path)
+
+        if self.path.startswith('/next?'):
+            return self.processNextEpisodeRequest(self.path)
 
         if self.path.startswith("/"+self.streamProxyPath()):
             #go to physical resource path
@@ -452,6 +733,9 @@ class ShnoodleServerHandler(BaseHTTPRequestHandler):
         if self.path.startswith('/thumb?'):
            return self.processThumbnailRequest(self.path)
 
+        if self.path.startswith('/trickplay?'):
+            return self.processTrickplayRequest(self.path)
+
         path = self.path.strip()
         if not path or path == "/":
             path = self.conf().get("defaultFile")
@@ -0,0 +1,112 @@
+import re
+from bisect import insort, bisect_left
+
+"""
+shows grouped into seasons with their episodes in order, built while the library is scanned
+episode markers (S01E02) are parsed into numbers once, episodes of a season are kept sorted
+and the next episode of every episode is looked up from a map that is rebuilt for a show only
+when one of its episodes was added or removed
+all methods are expected to be called under the library lock
+"""
+
+class ShowIndex:
+    __episodeRegex = re.compile("[Ss]([0-9]{1,2})[Ee]([0-9]{1,2})")
+
+    def __init__(self) -> None:
+        self.__shows = {}    # show -> {season: [(episode, name, uuid)]}
+        self.__episodes = {} # uuid -> (show, season, (episode, name, uuid))
+        self.__next = {}     # uuid -> uuid of the next episode, for shows that are not dirty
+        self.__dirty = set() # shows that changed since their next episodes were linked
+
+    @classmethod
+    def parseEpisode(cls, episode):
+        """ S01E02 -> (1, 2), None if it's not an episode marker """
+        if not episode:
+            return None
+        match = cls.__episodeRegex.search(episode)
+        if not match:
+            return None
+        return int(match.group(1)), int(match.group(2))
+
+    ########################################################################
+    # changing the index
+    ########################################################################
+
+    def add(self, uuid, record):
+        if not record.show:
+            return
+        parsed = self.parseEpisode(record.episode)
+        if not parsed:
+            return
+
+        season, episode = parsed
+        entry = (episode, record.name.casefold(), uuid)
+        insort(self.__shows.setdefault(record.show, {}).setdefault(season, []), entry)
+        self.__episodes[uuid] = (record.show, season, entry)
+        self.__dirty.add(record.show)
+
+    def remove(self, uuid):
+        found = self.__episodes.pop(uuid, None)
+        if not found:
+            return
+
+        show, season, entry = found
+        seasons = self.__shows[show]
+        episodes = seasons[season]
+        del episodes[bisect_left(episodes, entry)]
+        if not episodes:
+            del seasons[season]
+        if not seasons:
+            del self.__shows[show]
+        self.__next.pop(uuid, None)
+        self.__dirty.add(show)
+
+    def __link(self, show):
+        """ point every episode of show to the one after it (the next season continues the previous one) """
+        self.__dirty.discard(show)
+        previous = None
+        for season in sorted(self.__shows.get(show, {})):
+            for _, _, uuid in self.__shows[show][season]:
+                if previous:
+                    self.__next[previous] = uuid
+                previous = uuid
+        if previous:
+            self.__next.pop(previous, None)
+
+    ########################################################################
+    # lookups
+    ########################################################################
+
+    def shows(self):
+        """ [(show, [seasons], number of episodes, uuid of the first episode)] sorted by show """
+        found = []
+        for show in sorted(self.__shows, key=str.casefold):
+            seasons = sorted(self.__shows[show])
+            count = sum(len(episodes) for episodes in self.__shows[show].values())
+            found.append((show, seasons, count, self.__shows[show][seasons[0]][0][2]))
+        return found
+
+    def seasons(self, show, season=None):
+        """ [(season, [(episode, uuid)])] of show in order, only season if one is given """
+        seasons = self.__shows.get(show)
+        if not seasons:
+            return []
+        numbers = sorted(seasons) if season is None else [season] if season in seasons else []
+        return [(number, [(episode, uuid) for episode, _, uuid in seasons[number]]) for number in numbers]
+
+    def episode(self, uuid):
+        """ (show, season, episode) of uuid or None """
+        found = self.__episodes.get(uuid)
+        if not found:
+            return None
+        show, season, (episode, _, _) = found
+        return show, season, episode
+
+    def next(self, uuid):
+        """ uuid of the episode after uuid, None if it's the last one (or not an episode) """
+        found = self.__episodes.get(uuid)
+        if not found:
+            return None
+        if found[0] in self.__dirty:
+            self.__link(found[0])
+        return self.__next.get(uuid)
@@ -0,0 +1,120 @@
+import os
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from Shnoolog import Shnoolog
+
+"""
+thumbnails kept in memory up to a byte budget, the least recently used ones are evicted first
+with a spill directory, evicted thumbnails are written there (up to their own byte budget) and read
+back when they're asked for again instead of being generated again by ffmpeg
+the spill directory is in resource_path and removed on exit with the rest of the generated files
+"""
+
+class ThumbnailCache:
+
+    def __init__(self, memoryBytes, spillPath=None, spillBytes=0) -> None:
+        self.logger = Shnoolog("ThumbnailCache")
+        self.memoryBytes = memoryBytes
+        self.spillPath = spillPath if spillBytes > 0 else None
+        self.spillBytes = spillBytes
+        self.__memory = OrderedDict() # key -> thumb, least recently used first
+        self.__memorySize = 0
+        self.__spilled = OrderedDict() # key -> (file, size, thumb without the data)
+        self.__spilledSize = 0
+        self.__lock = threading.Lock()
+
+    def __spillFile(self, key):
+        return os.path.join(self.spillPath, hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def __spill(self, key, thumb):
+        self.__dropSpilled(key)
+        if not self.spillPath or thumb['size'] > self.spillBytes:
+            return
+        file = self.__spillFile(key)
+        try:
+            os.makedirs(self.spillPath, exist_ok=True)
+            with open(file, "wb") as spillFile:
+                spillFile.write(thumb['data'])
+        except OSError as e:
+            self.logger.error(f"Failed to spill thumbnail to {file}: {e}")
+            return
+
+        self.__spilled[key] = (file, thumb['size'], {name: value for name, value in thumb.items() if name != 'data'})
+        self.__spilledSize += thumb['size']
+        while self.__spilledSize > self.spillBytes:
+            _, (oldFile, size, _) = self.__spilled.popitem(last=False)
+            self.__spilledSize -= size
+            try:
+                os.remove(oldFile)
+            except OSError:
+                pass
+
+    def __dropSpilled(self, key):
+        """ removes the spilled copy of key (if there's one) from disk and from the spill budget """
+        spilled = self.__spilled.pop(key, None)
+        if not spilled:
+            return
+        file, size, _ = spilled
+        self.__spilledSize -= size
+        try:
+            os.remove(file)
+        except OSError:
+            pass
+
+    def __unspill(self, key):
+        file, size, thumb = self.__spilled.pop(key)
+        self.__spilledSize -= size
+        try:
+            with open(file, "rb") as spillFile:
+                data = spillFile.read()
+            os.remove(file)
+        except OSError as e:
+            self.logger.error(f"Failed to read spilled thumbnail {file}: {e}")
+            return None
+        return dict(thumb, data=data)
+
+    def __evict(self):
+        while self.__memorySize > self.memoryBytes and self.__memory:
+            key, thumb = self.__memory.popitem(last=False)
+            self.__memorySize -= thumb['size']
+            self.__spill(key, thumb)
+
+    def get(self, key):
+        with self.__lock:
+            thumb = self.__memory.get(key)
+            if thumb:
+                self.__memory.move_to_end(key)
+                return thumb
+            if key not in self.__spilled:
+                return None
+            thumb = self.__unspill(key)
+            if thumb:
+                self.__memory[key] = thumb
+                self.__memorySize += thumb['size']
+                self.__evict()
+            return thumb
+
+    def put(self, key, thumb):
+        with self.__lock:
+            old = self.__memory.pop(key, None)
+            if old:
+                self.__memorySize -= old['size']
+            self.__dropSpilled(key) # the new thumbnail replaces the one on disk too
+            self.__memory[key] = thumb
+            self.__memorySize += thumb['size']
+            self.__evict()
+
+    def usage(self):
+        """ (bytes in memory, bytes spilled) """
+        return self.__memorySize, self.__spilledSize
+
+    def clear(self):
+        with self.__lock:
+            self.__memory.clear()
+            self.__memorySize = 0
+            self.__spilled.clear()
+            self.__spilledSize = 0
+            if self.spillPath and os.path.exists(self.spillPath):
+                shutil.rmtree(self.spillPath, ignore_errors=True)
@@ -3,6 +3,8 @@ from http.server import ThreadingHTTPServer
 import os
 import sys
 import MediaLibrary
+import LibraryWatcher
+import ProbeWarmer
 import shUtils
 import FFMpeg
 import Patches
@@ -32,6 +34,16 @@ def runServer(config, context):
     logger.logInfo(f'Starting httpd on http://{ip}:{port}...')
     httpd.serve_forever()
 
+def cacheFilePath(config, filename):
+    """ path of filename in cache_path (created if it's missing), None if it can't be created """
+    cachePath = config.get('cache_path', 'cache')
+    try:
+        os.makedirs(cachePath, exist_ok=True)
+    except OSError as e:
+        logger.logWarn(f"Failed to create cache_path {cachePath}. {e}")
+        return None
+    return os.path.join(cachePath, filename)
+
 def initServer(configPath):
     config = Config(configPath)
     htmlCache = HTMLPYCache(config)
@@ -54,6 +66,13 @@ def initServer(configPath):
     htmlCache.add(html404Path)
     htmlCache.add(indexPath)
 
+    renditions = config.get('thumbRenditions')
+    if renditions is not None:
+        widths = [width for width in renditions if type(width) is int and width > 0] if isinstance(renditions, list) else []
+        if not widths or len(widths) != len(renditions):
+            logger.logError(f"thumbRenditions should be a list of positive widths, got {renditions}. using {widths or ShnoodleServerHandler.thumbRenditions}")
+        config.set('thumbRenditions', widths or ShnoodleServerHandler.thumbRenditions)
+
     gpuWrapper = None
     if config.get('gpu',Config.GPU.NONE) == Config.GPU.NONE:
         logger.logWarn("No GPU defined in conf file, GPU encoding it turned off")
@@ -74,11 +93,26 @@ def initServer(configPath):
     except Exception as e:
         logger.logWarn(f"Failed to load patches,'{e}'. no patches will be applied")
 
+    manifestPath = None
+    if config.get('scanManifest', False):
+        manifestPath = cacheFilePath(config, 'scan_manifest.json')
+        if not manifestPath:
+            logger.logWarn("scan manifest disabled")
+
+    probeStorePath = None
+    if config.get('probeStore', False):
+        probeStorePath = cacheFilePath(config, 'probe_store.json')
+        if not probeStorePath:
+            logger.logWarn("probe store disabled")
+
     library = MediaLibrary.MediaLibrary(config.get("mediaPaths",[]),
                                         config.get("allowedMediaExt",[]),
                                         config.get("allowedSubtitleExt",[]),
                                         config.get('blacklist',""),
-                                        patches)
+                                        patches,
+                                        scanWorkers=config.get('scanWorkers',8),
+                                        scanProcesses=config.get('scanProcesses',0),
+                                        manifestPath=manifestPath)
 
     resourcePath = config.get("resource_path")
 
@@ -101,11 +135,31 @@ def initServer(configPath):
     ffmpeg = FFMpeg.FFMpeg(ffmpegPath=config.get('ffmpeg','ffmpeg'),
                            ffprobePath=config.get('ffprobe','ffprobe'),
                            cdnPath=resourcePath,
-                           patches=patches)
-
+                           patches=patches,
+                           probeStorePath=probeStorePath,
+                           thumbWorkers=config.get('thumbWorkers', 2),
+                           thumbQueueLimit=config.get('thumbQueueLimit', 32),
+                           thumbCacheBytes=config.get('thumbCacheMB', 64) * 1024 * 1024,
+                           thumbSpillBytes=config.get('thumbSpillMB', 512) * 1024 * 1024,
+                           thumbBatch=config.get('thumbBatch', True),
+                           thumbBatchWidths=config.get('thumbBatchWidths', []),
+                           thumbModes=config.get('thumbModes', {}),
+                           thumbLatencyBudgetSeconds=config.get('thumbLatencyBudgetMs', 2000) / 1000,
+                           trickplayIntervalSeconds=config.get('trickplayIntervalSeconds', 10),
+                           trickplayWidth=config.get('trickplayWidth', 160))
+
+    watcher = None
+    warmer = None
     try:
         ffmpeg.initVideoFiles()
         library.scan()
+        if config.get('watchLibrary', False):
+            watcher = LibraryWatcher.LibraryWatcher(library, batchDelaySeconds=config.get('watchBatchSeconds', 2))
+            if not watcher.start():
+                watcher = None
+        if config.get('probeWarmup', True):
+            warmer = ProbeWarmer.ProbeWarmer(library, ffmpeg, workers=config.get('probeWorkers', 1))
+            warmer.start()
         context = ShnoodleServerContext(config, htmlCache, ffmpeg, library, telemetry, gpuWrapper)
         context.suppressFFMpegOutput()
         runServer(config, context)
@@ -116,6 +170,16 @@ def initServer(configPath):
         pass
     finally:
         logger.logInfo("Program terminated, cleaning up...")
+        if watcher:
+            watcher.stop()
+        if warmer:
+            warmer.stop()
+        # no probe is started or stored after this, the store is saved as it ends up
+        ffmpeg.thumbJobs.shutdown()
+        ffmpeg.probeJobs.shutdown()
+        if ffmpeg.probes.path:
+            logger.logInfo("Probe store...")
+            ffmpeg.probes.save(keep=library.absolutePaths())
         logger.logInfo("Video Files...")
         ffmpeg.clearVideoFiles()
         logger.logInfo("Done.")
@@ -0,0 +1,67 @@
+import os
+import re
+import sys
+import unittest
+
+testsPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(testsPath, "..", "src"))
+from MediaLibrary import MediaLibrary
+
+"""
+MediaLibrary.sanitize against the implementation it replaced (compound words removed one str.replace
+at a time in list order, blacklisted tokens looked up in a list), over the release names of the benchmark corpus
+"""
+
+corpusPath = os.path.join(testsPath, "..", "benchmarks", "corpus")
+
+def referenceSanitize(library, str):
+    str = re.sub(r"\([^\)]+\)", "", str)
+    str = re.sub(r"\[[^\]]+\]", "", str)
+    str = re.sub(r"\{[^\}]+\}", "", str)
+
+    for word in library.compoundBlacklist:
+        str = str.replace(word, "")
+
+    sep = " "
+    str = re.sub(r"[\.\-_\s]+", sep, str)
+
+    newStr = ""
+    for token in str.split(sep):
+        if not token:
+            continue
+        if not token in library.blacklist:
+            newStr = newStr + " " + token
+    return newStr.strip()
+
+class SanitizeTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(corpusPath, "release_names.txt"), "r") as corpusFile:
+            self.corpus = [line.strip() for line in corpusFile if line.strip()]
+
+    def assertSameAsReference(self, blacklistPath):
+        library = MediaLibrary([os.sep], ["mkv", "mp4", "mov"], ["srt"], blacklistPath, None)
+        self.assertTrue(library.compoundBlacklist)
+        for path in self.corpus:
+            for name in [path] + path.split("/"):
+                stem, _ = os.path.splitext(name)
+                stem = library.sanitizeEpisodeNumbers(stem)
+                self.assertEqual(library.sanitize(name).encode(), referenceSanitize(library, name).encode(), name)
+                self.assertEqual(library.sanitizeFilename(name).encode(), referenceSanitize(library, stem).encode(), name)
+
+    def testWordsPattern(self):
+        # same matches as an alternation of the words sorted longest first
+        words = ["WEB-DL", "WEB", "H.264", "H.265", "H.26", "DDP5.1", "DD5.1", "DD", "5.1", "a.b", "a.bc", "abc"]
+        alternation = re.compile("|".join(re.escape(word) for word in sorted(words, key=len, reverse=True)))
+        trie = re.compile(MediaLibrary.wordsPattern(words))
+        for text in self.corpus + ["WEB-DLH.264DDP5.1", "a.bca.b.abcDD5.15.1", "H.2H.26H.2645"]:
+            self.assertEqual(trie.findall(text), alternation.findall(text), text)
+
+    def testCorpusBlacklist(self):
+        self.assertSameAsReference(os.path.join(corpusPath, "blacklist.json"))
+
+    def testExampleBlacklist(self):
+        self.assertSameAsReference(os.path.join(testsPath, "..", "blacklist_example.json"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import sys
+import unittest
+
+testsPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(testsPath, "..", "src"))
+from MediaLibrary import MediaLibrary
+
+"""
+MediaLibrary.tokenizeFilename against the separate functions it stands for, over the release names of the benchmark corpus
+"""
+
+corpusPath = os.path.join(testsPath, "..", "benchmarks", "corpus")
+
+def referenceLang(library, filename):
+    for lang in library.langList:
+        for variation in (lang.lower(), lang.upper(), lang[0:2].lower(), lang[0:2].upper(), lang[0:1].upper()+lang[1:]):
+            if variation in filename:
+                return lang
+    return ""
+
+class TokenizeTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(corpusPath, "release_names.txt"), "r") as corpusFile:
+            corpus = [line.strip() for line in corpusFile if line.strip()]
+        self.names = [name for path in corpus for name in [path] + path.split("/")]
+        self.names += ["Queen.ITA.mkv", "x.Jpn.eN.mkv", "spaeng.mkv", "S01E02.mkv", "Show.mkvS01E05", "a.S01E01.b.S02E03.c[x](y){z}.mkv"]
+        self.library = MediaLibrary([os.sep], ["mkv", "mp4", "mov"], ["srt"], os.path.join(corpusPath, "blacklist.json"), None)
+
+    def testSameAsSeparateFunctions(self):
+        library = self.library
+        for name in self.names:
+            tokens = library.tokenizeFilename(name)
+            self.assertEqual(tokens.name, library.sanitizeFilename(name), name)
+            self.assertEqual(tokens.tokens, tokens.name.split(), name)
+            self.assertEqual(tokens.episode, library.extractEpisodeNumber(name), name)
+            self.assertEqual(tokens.lang, referenceLang(library, name), name)
+
+if __name__ == "__main__":
+    unittest.main()